@@ -6,14 +6,28 @@ Multigrade AI Teaching Assistant. It includes specialized agents for generating
 various types of educational content for multigrade classrooms (Grades 1-4).
 """
 
+import asyncio
+import copy
+import io
 import json
 import os
-from typing import Dict, Any, Optional, List
+import string
+import threading
+import time
+from typing import Dict, Any, Optional, List, Tuple
+from collections import OrderedDict
 from dataclasses import dataclass
 from enum import Enum
 
 import google.generativeai as genai
 
+# Optional: the google-genai SDK provides Gemini Batch Mode (used by generate_all_content)
+try:
+    from google import genai as google_genai
+    from google.genai import types as genai_types
+except ImportError:
+    google_genai = None
+
 # Load environment variables from .env file if it exists
 try:
     from dotenv import load_dotenv
@@ -24,9 +38,27 @@ except ImportError:
 # ---------------- CONFIGURATION ----------------
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY", "")
 GEMINI_MODEL = "gemini-2.0-flash"
-MAX_TOKENS = 2048
+MAX_TOKENS = 2048  # default; agents set their own "max_output_tokens" in AGENT_PROMPTS
 TEMPERATURE = 0.7
 
+# Opt-in response cache (use_cache=True): parsed responses kept for exact repeats of a request
+RESPONSE_CACHE_SIZE = 128
+
+# Batch Mode polling: seconds between status checks and the states that end a job
+BATCH_POLL_INTERVAL = 10
+BATCH_DONE_STATES = {"JOB_STATE_SUCCEEDED", "JOB_STATE_FAILED", "JOB_STATE_CANCELLED", "JOB_STATE_EXPIRED"}
+
+# Service tier per agent: Flex (discounted, slower) for prep material generated ahead of class,
+# standard for the plans/activities a teacher is usually waiting on
+DEFAULT_SERVICE_TIERS = {
+    "course_planner": "standard",
+    "activity_generator": "standard",
+    "worksheet_generator": "flex",
+    "assessment_generator": "flex",
+    "visual_aids_generator": "flex",
+    "peer_activity_generator": "flex"
+}
+
 # Grade configurations
 GRADES = ["Grade 1", "Grade 2", "Grade 3", "Grade 4"]
 SUBJECTS = ["English", "Mathematics", "Science", "Social Studies", "Hindi", "Art & Craft"]
@@ -53,21 +85,87 @@ class TeachingContext:
 class MultigradeAIAgent:
     def __init__(self, agent_type: AgentType):
         self.agent_type = agent_type
-        self.model = genai.GenerativeModel(GEMINI_MODEL)
+        self.model = get_agent_model(agent_type)
+        self.generation_config = AGENT_GENERATION_CONFIGS[agent_type]
         
-    def generate_content(self, prompt: str, context: TeachingContext) -> Dict[str, Any]:
+    def tier_config(self, service_tier: str):
+        """google-genai request config for a non-standard service tier (e.g. Flex)"""
+        return genai_types.GenerateContentConfig(
+            system_instruction=AGENT_PREFIXES[self.agent_type],
+            service_tier=service_tier,
+            **self.generation_config
+        )
+        
+    def generate_content(self, prompt: str, context: TeachingContext, service_tier: str = "standard") -> Dict[str, Any]:
+        try:
+            if service_tier != "standard" and google_genai is not None:
+                response = get_genai_client().models.generate_content(
+                    model=GEMINI_MODEL, contents=prompt, config=self.tier_config(service_tier)
+                )
+            else:
+                response = self.model.generate_content(prompt, generation_config=self.generation_config)
+            return {"success": True, "content": response.text}
+        except Exception as e:
+            return {"success": False, "error": str(e)}
+    
+    async def agenerate_content(self, prompt: str, context: TeachingContext, service_tier: str = "standard") -> Dict[str, Any]:
         try:
-            response = self.model.generate_content(prompt)
+            if service_tier != "standard" and google_genai is not None:
+                response = await get_genai_client().aio.models.generate_content(
+                    model=GEMINI_MODEL, contents=prompt, config=self.tier_config(service_tier)
+                )
+            else:
+                response = await self.model.generate_content_async(prompt, generation_config=self.generation_config)
             return {"success": True, "content": response.text}
         except Exception as e:
             return {"success": False, "error": str(e)}
 
+class ResponseCache:
+    """LRU cache of parsed agent responses keyed by the full request
+    
+    Only exact repeats are served; the cached dict is deep-copied in and out so a caller
+    mutating its result can't change what later callers get.
+    """
+    def __init__(self, maxsize: int = RESPONSE_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+    
+    @staticmethod
+    def make_key(agent_type: AgentType, context: TeachingContext, additional_params: Dict[str, Any] = None) -> Tuple:
+        return (
+            agent_type,
+            context.topic,
+            tuple(context.learning_objectives),
+            tuple(sorted(context.grades)),
+            tuple(sorted(context.subjects)),
+            context.duration_minutes,
+            context.class_size,
+            json.dumps(additional_params or {}, sort_keys=True)
+        )
+    
+    def get(self, key: Tuple) -> Optional[Dict[str, Any]]:
+        content = self._entries.get(key)
+        if content is None:
+            return None
+        self._entries.move_to_end(key)
+        return copy.deepcopy(content)
+    
+    def put(self, key: Tuple, content: Dict[str, Any]):
+        self._entries[key] = copy.deepcopy(content)
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+    
+    def clear(self):
+        self._entries.clear()
+
+response_cache = ResponseCache()
+
 # ---------------- AI AGENT PROMPTS ----------------
 AGENT_PROMPTS = {
     AgentType.COURSE_PLANNER: {
-        "system": """You are a multigrade classroom course planning specialist. You create comprehensive daily lesson plans 
-        that accommodate multiple grade levels (1-4) simultaneously, ensuring differentiated instruction and smooth transitions 
-        between activities for different grade groups.""",
+        "system": "You are a multigrade (Grades 1-4) course planning specialist who writes differentiated daily lesson plans with smooth transitions between grade groups.",
+        "max_output_tokens": 2048,
         "template": """Create a detailed daily course plan for a multigrade classroom.
         
         CONTEXT:
@@ -131,9 +229,8 @@ AGENT_PROMPTS = {
     },
     
     AgentType.ACTIVITY_GENERATOR: {
-        "system": """You are a creative educational activity designer specializing in multigrade classrooms. 
-        You create engaging, hands-on activities that can be adapted for different grade levels while maintaining 
-        the core learning objectives.""",
+        "system": "You are a multigrade activity designer who creates hands-on activities adaptable to each grade level.",
+        "max_output_tokens": 1536,
         "template": """Generate creative learning activities for a multigrade classroom.
         
         CONTEXT:
@@ -187,8 +284,8 @@ AGENT_PROMPTS = {
     },
     
     AgentType.WORKSHEET_GENERATOR: {
-        "system": """You are a worksheet creation specialist for multigrade classrooms. You design printable worksheets 
-        that provide differentiated practice opportunities for students in grades 1-4.""",
+        "system": "You are a multigrade worksheet specialist who designs printable, differentiated practice for Grades 1-4.",
+        "max_output_tokens": 1536,
         "template": """Create a comprehensive worksheet set for multigrade classroom practice.
         
         CONTEXT:
@@ -246,8 +343,8 @@ AGENT_PROMPTS = {
     },
     
     AgentType.ASSESSMENT_GENERATOR: {
-        "system": """You are an assessment design expert for multigrade classrooms. You create fair, comprehensive 
-        assessments that evaluate student understanding across different grade levels and learning styles.""",
+        "system": "You are a multigrade assessment expert who designs fair assessments across grade levels and learning styles.",
+        "max_output_tokens": 1536,
         "template": """Design a comprehensive assessment strategy for multigrade classroom evaluation.
         
         CONTEXT:
@@ -305,8 +402,8 @@ AGENT_PROMPTS = {
     },
     
     AgentType.VISUAL_AIDS_GENERATOR: {
-        "system": """You are a visual learning specialist who creates descriptions for educational visual aids, 
-        charts, diagrams, and interactive displays suitable for multigrade classrooms.""",
+        "system": "You are a visual learning specialist who describes charts, diagrams and displays for multigrade classrooms.",
+        "max_output_tokens": 1024,
         "template": """Design visual aids and learning materials for multigrade classroom instruction.
         
         CONTEXT:
@@ -352,8 +449,8 @@ AGENT_PROMPTS = {
     },
     
     AgentType.PEER_ACTIVITY_GENERATOR: {
-        "system": """You are a collaborative learning specialist who designs peer-to-peer activities that promote 
-        cross-grade interaction, mentoring, and cooperative learning in multigrade settings.""",
+        "system": "You are a collaborative learning specialist who designs cross-grade peer mentoring and cooperative activities.",
+        "max_output_tokens": 1024,
         "template": """Create peer-to-peer learning activities for multigrade classroom collaboration.
         
         CONTEXT:
@@ -409,6 +506,88 @@ AGENT_PROMPTS = {
     }
 }
 
+def _split_template(template: str) -> Tuple[str, str]:
+    """Split a template into its per-call CONTEXT part and its static JSON-schema part"""
+    head, sep, schema = template.partition("Return a JSON structure with:")
+    return head, sep + schema.format()
+
+# Static prefix (system prompt + output schema) is byte-identical for every call of an agent,
+# so it goes first / into system_instruction where Gemini can serve it from cache
+AGENT_TEMPLATE_PARTS = {agent_type: _split_template(data["template"]) for agent_type, data in AGENT_PROMPTS.items()}
+AGENT_PREFIXES = {
+    agent_type: f"{AGENT_PROMPTS[agent_type]['system']}\n\n{schema}"
+    for agent_type, (_, schema) in AGENT_TEMPLATE_PARTS.items()
+}
+
+def schema_from_example(example) -> Dict[str, Any]:
+    """Gemini response_schema for a template's example JSON, whose leaves are "string (hint)" or "integer (hint)" text"""
+    if isinstance(example, dict):
+        return {
+            "type": "OBJECT",
+            "properties": {key: schema_from_example(value) for key, value in example.items()},
+            "required": list(example)
+        }
+    if isinstance(example, list):
+        return {"type": "ARRAY", "items": schema_from_example(example[0] if example else "string")}
+    type_name, _, hint = example.partition(" ")
+    schema = {"type": "INTEGER" if type_name == "integer" else "STRING"}
+    if hint:
+        schema["description"] = hint.strip("()")
+    return schema
+
+def _generation_config(schema_text: str, max_output_tokens: int) -> Dict[str, Any]:
+    # '["string"] or null' isn't JSON; such fields come back as (possibly empty) arrays
+    example = json.loads(schema_text.partition("Return a JSON structure with:")[2].replace("] or null", "]"))
+    return {
+        "response_mime_type": "application/json",
+        "response_schema": schema_from_example(example),
+        "temperature": TEMPERATURE,
+        "max_output_tokens": max_output_tokens
+    }
+
+# Structured output: Gemini is constrained to emit JSON matching each template's documented shape
+AGENT_GENERATION_CONFIGS = {
+    agent_type: _generation_config(schema, AGENT_PROMPTS[agent_type].get("max_output_tokens", MAX_TOKENS))
+    for agent_type, (_, schema) in AGENT_TEMPLATE_PARTS.items()
+}
+
+# How each template field is read from a TeachingContext
+_CONTEXT_FIELDS = {
+    "grades": lambda context: ', '.join(context.grades),
+    "subjects": lambda context: ', '.join(context.subjects),
+    "topic": lambda context: context.topic,
+    "duration_minutes": lambda context: str(context.duration_minutes),
+    "class_size": lambda context: str(context.class_size),
+    "learning_objectives": lambda context: ', '.join(context.learning_objectives),
+}
+
+def compile_template(template: str):
+    """Parse a format template once into a render(context) function"""
+    pieces = [
+        (literal, _CONTEXT_FIELDS[field_name] if field_name is not None else None)
+        for literal, field_name, _, _ in string.Formatter().parse(template)
+    ]
+    
+    def render(context: TeachingContext) -> str:
+        return "".join(
+            literal + getter(context) if getter is not None else literal
+            for literal, getter in pieces
+        )
+    return render
+
+AGENT_RENDERERS = {
+    agent_type: compile_template(head.strip())
+    for agent_type, (head, _) in AGENT_TEMPLATE_PARTS.items()
+}
+
+def get_agent_model(agent_type: AgentType):
+    """Model for an agent with its static prefix as system_instruction
+    
+    The prefixes are a few hundred tokens, far below the explicit CachedContent minimum,
+    so Gemini's implicit prefix caching is the only cache they can hit.
+    """
+    return genai.GenerativeModel(GEMINI_MODEL, system_instruction=AGENT_PREFIXES[agent_type])
+
 # ---------------- CORE FUNCTIONS ----------------
 def initialize_gemini_api(api_key: str = None) -> bool:
     """Initialize Gemini API with provided or environment API key"""
@@ -418,63 +597,141 @@ def initialize_gemini_api(api_key: str = None) -> bool:
     
     try:
         genai.configure(api_key=key)
-        # Test the connection
-        model = genai.GenerativeModel(GEMINI_MODEL)
-        test_response = model.generate_content("Say 'API connection successful'")
+        # Verify the key with a metadata lookup rather than a billed generation
+        genai.get_model(f"models/{GEMINI_MODEL}")
+        # Agents and clients built under a previous key are no longer valid
+        global _api_key, _genai_client
+        _api_key, _genai_client = key, None
+        _agents.clear()
         return True
     except Exception as e:
         raise RuntimeError(f"Failed to initialize Gemini API: {e}")
 
+_api_key = GEMINI_API_KEY
+_genai_client = None
+
+def get_genai_client():
+    """Shared google-genai client, used for Flex-tier requests"""
+    global _genai_client
+    if _genai_client is None:
+        _genai_client = google_genai.Client(api_key=_api_key)
+    return _genai_client
+
+# One shared agent (and GenerativeModel) per agent type, built on first use
+_agents: Dict[AgentType, MultigradeAIAgent] = {}
+
 def create_agent(agent_type: AgentType) -> MultigradeAIAgent:
-    """Factory function to create AI agents"""
-    return MultigradeAIAgent(agent_type)
+    """Return the shared agent for agent_type"""
+    agent = _agents.get(agent_type)
+    if agent is None:
+        agent = _agents[agent_type] = MultigradeAIAgent(agent_type)
+    return agent
+
+def build_agent_request(
+    agent_type: AgentType,
+    context: TeachingContext,
+    additional_params: Dict[str, Any] = None
+) -> str:
+    """Format the per-call part of an agent prompt (everything but the static prefix)"""
+    request = AGENT_RENDERERS[agent_type](context)
+    
+    if additional_params:
+        request += f"\n\nAdditional Parameters: {json.dumps(additional_params)}"
+    return request
+
+def build_agent_prompt(
+    agent_type: AgentType,
+    context: TeachingContext,
+    additional_params: Dict[str, Any] = None
+) -> str:
+    """Full single-string prompt: static prefix first so repeated calls share a cacheable prefix"""
+    return f"{AGENT_PREFIXES[agent_type]}\n\n{build_agent_request(agent_type, context, additional_params)}"
+
+def parse_agent_result(agent_type: AgentType, result: Dict[str, Any]) -> Dict[str, Any]:
+    """Parse a raw agent result into JSON content, keeping raw text as a fallback"""
+    if not result["success"]:
+        return result
+    
+    parsed_content = safe_parse_json(result["content"])
+    if parsed_content is not None:
+        return {
+            "success": True,
+            "content": parsed_content,
+            "raw_content": result["content"],
+            "agent_type": agent_type.value
+        }
+    
+    # If JSON parsing fails, return raw content
+    return {
+        "success": True,
+        "content": result["content"],
+        "raw_content": result["content"],
+        "agent_type": agent_type.value,
+        "note": "Content returned as raw text (not JSON)"
+    }
+
+def cached_agent_result(agent_type: AgentType, content: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "success": True,
+        "content": content,
+        "raw_content": json.dumps(content),
+        "agent_type": agent_type.value,
+        "cached": True
+    }
 
 def generate_content_with_agent(
     agent_type: AgentType, 
     context: TeachingContext, 
-    additional_params: Dict[str, Any] = None
+    additional_params: Dict[str, Any] = None,
+    use_cache: bool = False,
+    service_tier: str = None
 ) -> Dict[str, Any]:
-    """Generate content using specified AI agent"""
+    """Generate content using specified AI agent
+    
+    With use_cache, an identical earlier request (same topic, objectives and context) is
+    returned from response_cache without calling Gemini.
+    service_tier defaults to the agent's DEFAULT_SERVICE_TIERS entry.
+    """
+    service_tier = service_tier or DEFAULT_SERVICE_TIERS[agent_type.value]
     try:
         agent = create_agent(agent_type)
-        prompt_data = AGENT_PROMPTS[agent_type]
-        
-        # Format the prompt with context
-        formatted_prompt = f"{prompt_data['system']}\n\n{prompt_data['template'].format(
-            grades=', '.join(context.grades),
-            subjects=', '.join(context.subjects),
-            topic=context.topic,
-            duration_minutes=context.duration_minutes,
-            class_size=context.class_size,
-            learning_objectives=', '.join(context.learning_objectives)
-        )}"
-        
-        if additional_params:
-            formatted_prompt += f"\n\nAdditional Parameters: {json.dumps(additional_params)}"
+        cache_key = ResponseCache.make_key(agent_type, context, additional_params)
+        if use_cache and (content := response_cache.get(cache_key)) is not None:
+            return cached_agent_result(agent_type, content)
         
-        result = agent.generate_content(formatted_prompt, context)
+        request = build_agent_request(agent_type, context, additional_params)
+        result = parse_agent_result(agent_type, agent.generate_content(request, context, service_tier))
+        if use_cache and result["success"] and isinstance(result["content"], dict):
+            response_cache.put(cache_key, result["content"])
+        return result
+            
+    except Exception as e:
+        return {
+            "success": False,
+            "error": f"Agent generation failed: {str(e)}",
+            "agent_type": agent_type.value
+        }
+
+async def agenerate_content_with_agent(
+    agent_type: AgentType, 
+    context: TeachingContext, 
+    additional_params: Dict[str, Any] = None,
+    use_cache: bool = False,
+    service_tier: str = None
+) -> Dict[str, Any]:
+    """Async generate_content_with_agent, so several agents can run concurrently"""
+    service_tier = service_tier or DEFAULT_SERVICE_TIERS[agent_type.value]
+    try:
+        agent = create_agent(agent_type)
+        cache_key = ResponseCache.make_key(agent_type, context, additional_params)
+        if use_cache and (content := response_cache.get(cache_key)) is not None:
+            return cached_agent_result(agent_type, content)
         
-        if result["success"]:
-            # Try to parse JSON response
-            try:
-                parsed_content = json.loads(result["content"])
-                return {
-                    "success": True,
-                    "content": parsed_content,
-                    "raw_content": result["content"],
-                    "agent_type": agent_type.value
-                }
-            except json.JSONDecodeError:
-                # If JSON parsing fails, return raw content
-                return {
-                    "success": True,
-                    "content": result["content"],
-                    "raw_content": result["content"],
-                    "agent_type": agent_type.value,
-                    "note": "Content returned as raw text (not JSON)"
-                }
-        else:
-            return result
+        request = build_agent_request(agent_type, context, additional_params)
+        result = parse_agent_result(agent_type, await agent.agenerate_content(request, context, service_tier))
+        if use_cache and result["success"] and isinstance(result["content"], dict):
+            response_cache.put(cache_key, result["content"])
+        return result
             
     except Exception as e:
         return {
@@ -483,6 +740,118 @@ def generate_content_with_agent(
             "agent_type": agent_type.value
         }
 
+def generate_all_content(
+    context: TeachingContext,
+    additional_params: Dict[AgentType, Dict[str, Any]] = None,
+    agent_types: List[AgentType] = None,
+    api_key: str = None,
+    poll_interval: float = BATCH_POLL_INTERVAL
+) -> Dict[AgentType, Dict[str, Any]]:
+    """Generate every agent's content for one context as a single Gemini Batch Mode job
+    
+    Batch jobs are billed at half the interactive price but complete asynchronously
+    (typically minutes), so use this for non-interactive lesson prep. Falls back to
+    one synchronous call per agent when the google-genai SDK is not installed.
+    """
+    agent_types = agent_types or list(AgentType)
+    additional_params = additional_params or {}
+    prompts = {
+        agent_type: build_agent_prompt(agent_type, context, additional_params.get(agent_type))
+        for agent_type in agent_types
+    }
+    
+    if google_genai is None:
+        return {
+            agent_type: generate_content_with_agent(agent_type, context, additional_params.get(agent_type))
+            for agent_type in agent_types
+        }
+    
+    try:
+        client = google_genai.Client(api_key=api_key) if api_key else get_genai_client()
+        
+        # One JSONL line per agent, keyed so results can be routed back
+        jsonl = "\n".join(
+            json.dumps({
+                "key": agent_type.value,
+                "request": {
+                    "contents": [{"role": "user", "parts": [{"text": prompt}]}],
+                    "generation_config": AGENT_GENERATION_CONFIGS[agent_type]
+                }
+            })
+            for agent_type, prompt in prompts.items()
+        )
+        batch_file = client.files.upload(
+            file=io.BytesIO(jsonl.encode("utf-8")),
+            config=genai_types.UploadFileConfig(display_name=f"multigrade-{context.topic}", mime_type="jsonl")
+        )
+        batch_job = client.batches.create(model=GEMINI_MODEL, src=batch_file.name)
+        
+        while batch_job.state.name not in BATCH_DONE_STATES:
+            time.sleep(poll_interval)
+            batch_job = client.batches.get(name=batch_job.name)
+        
+        if batch_job.state.name != "JOB_STATE_SUCCEEDED":
+            raise RuntimeError(f"Batch job ended in state {batch_job.state.name}")
+        
+        outputs = {}
+        for line in client.files.download(file=batch_job.dest.file_name).decode("utf-8").splitlines():
+            if line.strip():
+                output = json.loads(line)
+                outputs[output.get("key")] = output
+    except Exception as e:
+        return {
+            agent_type: {
+                "success": False,
+                "error": f"Batch generation failed: {str(e)}",
+                "agent_type": agent_type.value
+            }
+            for agent_type in agent_types
+        }
+    
+    results = {}
+    for agent_type in agent_types:
+        output = outputs.get(agent_type.value, {})
+        try:
+            parts = output["response"]["candidates"][0]["content"]["parts"]
+            result = {"success": True, "content": "".join(part.get("text", "") for part in parts)}
+        except (KeyError, IndexError, TypeError):
+            result = {"success": False, "error": str(output.get("error", "No response returned for this request"))}
+        results[agent_type] = parse_agent_result(agent_type, result)
+    return results
+
+async def agenerate_lesson_pack(
+    context: TeachingContext,
+    additional_params: Dict[AgentType, Dict[str, Any]] = None,
+    agent_types: List[AgentType] = None
+) -> Dict[AgentType, Dict[str, Any]]:
+    """Generate every agent's content for one context concurrently (wall time ~ the slowest agent)"""
+    agent_types = agent_types or list(AgentType)
+    additional_params = additional_params or {}
+    results = await asyncio.gather(*[
+        agenerate_content_with_agent(agent_type, context, additional_params.get(agent_type))
+        for agent_type in agent_types
+    ])
+    return dict(zip(agent_types, results))
+
+_event_loop: Optional[asyncio.AbstractEventLoop] = None
+
+def get_event_loop() -> asyncio.AbstractEventLoop:
+    """Long-lived background event loop (the SDK's async client stays bound to the loop it first ran on)"""
+    global _event_loop
+    if _event_loop is None:
+        _event_loop = asyncio.new_event_loop()
+        threading.Thread(target=_event_loop.run_forever, daemon=True).start()
+    return _event_loop
+
+def generate_lesson_pack(
+    context: TeachingContext,
+    additional_params: Dict[AgentType, Dict[str, Any]] = None,
+    agent_types: List[AgentType] = None
+) -> Dict[AgentType, Dict[str, Any]]:
+    """Synchronous wrapper around agenerate_lesson_pack"""
+    coro = agenerate_lesson_pack(context, additional_params, agent_types)
+    return asyncio.run_coroutine_threadsafe(coro, get_event_loop()).result()
+
 # ---------------- SPECIALIZED CONTENT GENERATORS ----------------
 def generate_course_plan(
     grades: List[str], 
@@ -613,15 +982,11 @@ def generate_peer_activity(
 
 # ---------------- UTILITY FUNCTIONS ----------------
 def safe_parse_json(s: str) -> Optional[Dict[str, Any]]:
-    """Safely parse JSON string with fallback options"""
+    """Parse a JSON response (fence-free, since agents request application/json output); None if invalid"""
     try:
         return json.loads(s)
     except Exception:
-        s2 = s.strip().strip("`").strip()
-        try:
-            return json.loads(s2)
-        except Exception:
-            return None
+        return None
 
 def validate_context(context: TeachingContext) -> bool:
     """Validate TeachingContext has required fields"""
@@ -1,11 +1,19 @@
 import streamlit as st
-import pdfplumber
-from PyPDF2 import PdfReader, PdfWriter
+import fitz  # PyMuPDF
 import re
-import io
 import firebase_admin
 from firebase_admin import credentials, firestore
 
+# Optional: Hyperscan (SIMD DFA) or google-re2 scan topic headers in linear time
+try:
+    import hyperscan
+except ImportError:
+    hyperscan = None
+try:
+    import re2
+except ImportError:
+    re2 = None
+
 # ---------------- PAGE CONFIG (must be first Streamlit call) ----------------
 st.set_page_config(page_title="Textbook Topic Splitter", layout="wide")
 
@@ -16,69 +24,96 @@ if not firebase_admin._apps:
 
 db = firestore.client()
 
+# Firestore allows at most 500 writes per batch commit
+FIRESTORE_BATCH_LIMIT = 500
+
 # ---------------- REGEX PATTERNS ----------------
-TOPIC_REGEX = re.compile(
-    r"(Two Little Hands|Parts of the Body|Let us [A-Za-z]+|Picture\s+(Talk|Time)|"
-    r"Sight words|New words|Alphabet song|Letter sounds|Odd One Out|Note to the teacher)",
-    re.IGNORECASE
-)
-MERGE_WITH_PREVIOUS = {"sight words", "new words", "note to the teacher"}
+TOPIC_PATTERNS = [
+    r"Two Little Hands", r"Parts of the Body", r"Let us [A-Za-z]+", r"Picture\s+(Talk|Time)",
+    r"Sight words", r"New words", r"Alphabet song", r"Letter sounds", r"Odd One Out", r"Note to the teacher"
+]
+TOPIC_REGEX = (re2 or re).compile("(?i)(" + "|".join(TOPIC_PATTERNS) + ")")
+
+if hyperscan is not None:
+    TOPIC_DB = hyperscan.Database()
+    TOPIC_DB.compile(
+        expressions=[pattern.encode() for pattern in TOPIC_PATTERNS],
+        ids=list(range(len(TOPIC_PATTERNS))),
+        elements=len(TOPIC_PATTERNS),
+        flags=[hyperscan.HS_FLAG_CASELESS | hyperscan.HS_FLAG_SOM_LEFTMOST] * len(TOPIC_PATTERNS)
+    )
+else:
+    TOPIC_DB = None
+MERGE_WITH_PREVIOUS = frozenset({"sight words", "new words", "note to the teacher"})
+_WS_RE = re.compile(r"\s+")
 
 
 # ---------------- PDF SPLITTING + TEXT EXTRACTION ----------------
-def split_pdf_by_topics(pdf_file):
-    """Splits a chapter PDF into topic-based sections and returns [(filename, pdf_bytes, text_content), ...]"""
-    topics = []
-    reader = PdfReader(pdf_file)
+def find_topic_header(text):
+    """Returns the leftmost topic header in a page's text (same match as TOPIC_REGEX.search), or None"""
+    if TOPIC_DB is None:
+        match = TOPIC_REGEX.search(text)
+        return match[0] if match else None
+
+    data = text.encode("utf-8")
+    best = []  # [start, pattern id, end] of the leftmost, first-listed, longest match
+
+    def on_match(pattern_id, start, end, flags, context):
+        if not best or (start, pattern_id, -end) < (best[0], best[1], -best[2]):
+            best[:] = [start, pattern_id, end]
 
-    with pdfplumber.open(pdf_file) as pdf:
+    TOPIC_DB.scan(data, match_event_handler=on_match)
+    return data[best[0]:best[2]].decode("utf-8") if best else None
+
+
+def split_pdf_by_topics(pdf_bytes):
+    """Splits a chapter PDF into topic-based sections, yielding (filename, text_content) one topic at a time"""
+    # Only the text is shown and saved, so no per-topic PDF is written
+    with fitz.open(stream=pdf_bytes, filetype="pdf") as doc:
         current_topic = None
-        topic_writer = PdfWriter()
+        start_page = 0
         topic_count = 0
-        topic_text = []  # store text for current topic
+        topic_buf = bytearray()  # UTF-8 text for current topic
 
-        for i, page in enumerate(pdf.pages):
-            text = page.extract_text() or ""
+        for i, page in enumerate(doc):
+            text = page.get_text("text")
 
             # Detect topic header
-            match = TOPIC_REGEX.search(text)
-            if match:
-                header_text = match.group(0).strip()
-                normalized = header_text.lower()
-
-                if normalized in MERGE_WITH_PREVIOUS and current_topic is not None:
+            # Header patterns never match surrounding whitespace, so no strip() is needed
+            header_text = find_topic_header(text)
+            if header_text:
+                if header_text.lower() in MERGE_WITH_PREVIOUS and current_topic is not None:
                     pass  # continue same topic
                 else:
                     # Save current topic
-                    if current_topic is not None and len(topic_writer.pages) > 0:
-                        pdf_bytes = io.BytesIO()
-                        topic_writer.write(pdf_bytes)
-                        pdf_bytes.seek(0)
-                        full_text = "\n".join(topic_text).strip()
-                        topics.append((f"{topic_count:02d}_{current_topic}.pdf", pdf_bytes, full_text))
+                    if current_topic is not None and i > start_page:
+                        full_text = topic_buf.decode("utf-8").strip()
+                        yield f"{topic_count:02d}_{current_topic}.pdf", full_text
 
                         # reset for new topic
-                        topic_writer = PdfWriter()
-                        topic_text = []
+                        start_page = i
+                        topic_buf = bytearray()
 
                     # Start new topic
-                    current_topic = re.sub(r"\s+", "_", header_text)
+                    current_topic = _WS_RE.sub("_", header_text)
                     topic_count += 1
 
-            # Add page + text
-            topic_writer.add_page(reader.pages[i])
-            if text.strip():
-                topic_text.append(text.strip())
+            # Add text
+            text = text.strip()
+            if text:
+                topic_buf += text.encode("utf-8")
+                topic_buf += b"\n"
 
         # Save last topic
-        if current_topic is not None and len(topic_writer.pages) > 0:
-            pdf_bytes = io.BytesIO()
-            topic_writer.write(pdf_bytes)
-            pdf_bytes.seek(0)
-            full_text = "\n".join(topic_text).strip()
-            topics.append((f"{topic_count:02d}_{current_topic}.pdf", pdf_bytes, full_text))
+        if current_topic is not None and len(doc) > start_page:
+            full_text = topic_buf.decode("utf-8").strip()
+            yield f"{topic_count:02d}_{current_topic}.pdf", full_text
+
 
-    return topics
+@st.cache_data(show_spinner=False, max_entries=8)
+def extract_topics(pdf_bytes):
+    """Cached [(filename, text_content), ...] for an upload, so reruns skip re-parsing the PDF"""
+    return list(split_pdf_by_topics(pdf_bytes))
 
 
 # ---------------- FIREBASE SAVE ----------------
@@ -91,11 +126,17 @@ def save_to_firebase(class_name, subject, chapter, topics):
     subject_ref = class_ref.collection("subjects").document(subject)
     chapter_ref = subject_ref.collection("chapters").document(chapter)
 
-    for i, (filename, _, content) in enumerate(topics, 1):
-        chapter_ref.collection("topics").document(f"topic{i}").set({
+    # One commit per FIRESTORE_BATCH_LIMIT topics instead of one round-trip per topic
+    batch = db.batch()
+    for i, (filename, content) in enumerate(topics, 1):
+        batch.set(chapter_ref.collection("topics").document(f"topic{i}"), {
             "title": filename.replace(".pdf", ""),
             "content": content
         })
+        if i % FIRESTORE_BATCH_LIMIT == 0:
+            batch.commit()
+            batch = db.batch()
+    batch.commit()
 
 
 # ---------------- STREAMLIT APP ----------------
@@ -108,12 +149,12 @@ uploaded_file = st.file_uploader("Upload Chapter PDF", type=["pdf"])
 
 if uploaded_file and subject and chapter_name and class_name:
     st.subheader(f"📖 Processing {uploaded_file.name}")
-    topics = split_pdf_by_topics(uploaded_file)
+    topics = extract_topics(uploaded_file.getvalue())
 
     st.success(f"Extracted {len(topics)} topics")
 
     # Show topics in Streamlit
-    for i, (filename, _, content) in enumerate(topics, 1):
+    for i, (filename, content) in enumerate(topics, 1):
         with st.expander(f"Topic {i}: {filename}"):
             st.text_area("Extracted Text", content, height=200)
 
@@ -1,31 +1,75 @@
 import os
-import json
 import time
+import asyncio
 import argparse
+import string
+import contextlib
+import functools
+import importlib.util
 from typing import Dict, Any, Iterable, Optional
 
 import firebase_admin
 from firebase_admin import credentials, firestore
+from google.api_core import exceptions as google_exceptions
 
-import requests  # for Ollama backend
+import httpx  # async client for Mistral and Ollama
+import orjson
+
+import llm_cache
+from llm_json import JsonObjectScanner, safe_parse_json
+
+# Optional: tiktoken for token-accurate topic truncation (character estimate otherwise)
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# Optional: aiolimiter for request-rate limiting (a simple interval limiter is used otherwise)
+try:
+    from aiolimiter import AsyncLimiter
+except ImportError:
+    AsyncLimiter = None
 
 
 # =============== CONFIG ===============
 BACKEND = os.getenv("BACKEND", "mistral").lower()  # "mistral" or "ollama"
 MISTRAL_API_KEY = os.getenv("MISTRAL_API_KEY", "")
 MISTRAL_MODEL = os.getenv("MISTRAL_MODEL", "mistral-large-latest")
+# Short topics (word lists, picture talk) go to the faster, cheaper small model
+MISTRAL_SMALL_MODEL = os.getenv("MISTRAL_SMALL_MODEL", "mistral-small-latest")
+SMALL_TOPIC_TOKENS = int(os.getenv("SMALL_TOPIC_TOKENS", "400"))
 
 # Ollama local settings (if using BACKEND=ollama)
 OLLAMA_HOST = os.getenv("OLLAMA_HOST", "http://localhost:11434")
 OLLAMA_MODEL = os.getenv("OLLAMA_MODEL", "mistral")  # ensure `ollama pull mistral`
+OLLAMA_KEEP_ALIVE = -1  # keep the model (and its cached prompt prefix) loaded between topics
 
 # Generation parameters (tweak as needed)
 MAX_TOKENS = int(os.getenv("MAX_TOKENS", "2048"))
 TEMPERATURE = float(os.getenv("TEMPERATURE", "0.3"))
 TOP_P = float(os.getenv("TOP_P", "0.9"))
 
+# Topic text budget sent to the model (characters only when tiktoken is unavailable)
+MAX_TOPIC_TOKENS = 3000
+MAX_TOPIC_CHARS = 12000
+
+# Concurrency / politeness defaults (overridable with --concurrency / --rpm)
+DEFAULT_CONCURRENCY = int(os.getenv("CONCURRENCY", "16"))
+DEFAULT_RPM = int(os.getenv("RPM", "75"))
+LLM_TIMEOUT = 120
+# Topics read ahead of the LLM workers (bounds memory while Firestore streams)
+WORK_QUEUE_SIZE = 32
+
+# Plans are saved in WriteBatches of up to this many topics (Firestore's limit is 500)
+FIRESTORE_BATCH_SIZE = 400
+COMMIT_RETRIES = 4
+TRANSIENT_ERRORS = (google_exceptions.Aborted, google_exceptions.DeadlineExceeded, google_exceptions.ServiceUnavailable)
+
 # Firestore collection names are fixed by your schema
 ROOT_COLLECTION = "classes"
+# Only these topic fields are fetched; ai_timestamp is written together with ai_plan_json,
+# so it marks finished topics without downloading the plan itself
+TOPIC_FIELDS = ["title", "content", "ai_timestamp"]
 
 # =============== FIREBASE INIT ===============
 if not firebase_admin._apps:
@@ -87,95 +131,122 @@ TOPIC TEXT:
 \"\"\"{topic_text}\"\"\"
 """
 
+def compile_template(template: str):
+    """Parse a str.format template once into a render(**fields) function (literals pre-unescaped)."""
+    pieces = [(literal, field_name) for literal, field_name, _, _ in string.Formatter().parse(template)]
+
+    def render(**fields) -> str:
+        return "".join(
+            literal + str(fields[field_name]) if field_name is not None else literal
+            for literal, field_name in pieces
+        )
+    return render
+
+
+render_user_prompt = compile_template(USER_PROMPT_TEMPLATE)
+
 # Optional: a Markdown pretty-printer for the JSON
 def plan_json_to_markdown(plan: Dict[str, Any]) -> str:
-    def bullets(items: Iterable[str]) -> str:
-        return "".join(f"- {it}\n" for it in items) if items else "-\n"
-
-    out = []
-    out.append(f"# {plan.get('title','Teaching Plan')}")
-    out.append(f"**Estimated Duration:** {plan.get('estimated_duration_min','-')} minutes\n")
+    # Every line is appended to one buffer and joined once at the end
+    buf = []
+    w = buf.append
+
+    def bullets(items: Iterable[str], sep: str = "\n") -> None:
+        if not items:
+            w("-\n")
+        for it in items or ():
+            w(f"- {it}\n")
+        w(sep)
+
+    def steps(section_name: str) -> None:
+        w(f"### {section_name.replace('_',' ').title()}\n")
+        for step in plan.get(section_name, []):
+            if isinstance(step, dict):
+                w(f"- Step {step.get('step','')}: {step.get('instruction','')}\n")
+            else:
+                w(f"- {step}\n")
 
-    out.append("## Learning Objectives")
-    out.append(bullets(plan.get("learning_objectives", [])))
+    w(f"# {plan.get('title','Teaching Plan')}\n")
+    w(f"**Estimated Duration:** {plan.get('estimated_duration_min','-')} minutes\n\n")
 
-    out.append("## Prerequisites")
-    out.append(bullets(plan.get("prerequisites", [])))
+    w("## Learning Objectives\n")
+    bullets(plan.get("learning_objectives", []))
 
-    out.append("## Key Vocabulary")
-    out.append(bullets(plan.get("key_vocabulary", [])))
+    w("## Prerequisites\n")
+    bullets(plan.get("prerequisites", []))
 
-    out.append("## Materials Needed")
-    out.append(bullets(plan.get("materials_needed", [])))
+    w("## Key Vocabulary\n")
+    bullets(plan.get("key_vocabulary", []))
 
-    def steps(section_name):
-        steps_list = plan.get(section_name, [])
-        s = [f"### {section_name.replace('_',' ').title()}"]
-        for step in steps_list:
-            if isinstance(step, dict):
-                s.append(f"- Step {step.get('step','')}: {step.get('instruction','')}")
-            else:
-                s.append(f"- {step}")
-        return "\n".join(s)
+    w("## Materials Needed\n")
+    bullets(plan.get("materials_needed", []))
 
-    out.append(steps("engage_warmup"))
-    out.append(steps("explicit_instruction"))
-    out.append(steps("guided_practice"))
+    steps("engage_warmup")
+    steps("explicit_instruction")
+    steps("guided_practice")
 
-    out.append("## Independent Practice")
+    w("## Independent Practice\n")
     for task in plan.get("independent_practice", []):
         if isinstance(task, dict):
-            out.append(f"- **Task:** {task.get('task','')}")
+            w(f"- **Task:** {task.get('task','')}\n")
             sc = task.get("success_criteria", [])
             if sc:
-                out.append("  - Success criteria:")
-                out.extend([f"    - {c}" for c in sc])
+                w("  - Success criteria:\n")
+                for c in sc:
+                    w(f"    - {c}\n")
         else:
-            out.append(f"- {task}")
+            w(f"- {task}\n")
 
-    out.append("## Differentiation")
+    w("## Differentiation\n")
     diff = plan.get("differentiation", {})
-    out.append("**Support**")
-    out.append(bullets(diff.get("support", [])))
-    out.append("**Challenge**")
-    out.append(bullets(diff.get("challenge", [])))
+    w("**Support**\n")
+    bullets(diff.get("support", []))
+    w("**Challenge**\n")
+    bullets(diff.get("challenge", []))
 
-    out.append("## Assessment")
+    w("## Assessment\n")
     assess = plan.get("assessment", {})
-    out.append("**Formative checks**")
-    out.append(bullets(assess.get("formative_checks", [])))
-    out.append(f"**Exit ticket:** {assess.get('exit_ticket','')}")
-    out.append("**Rubric points**")
-    out.append(bullets(assess.get("rubric_points", [])))
+    w("**Formative checks**\n")
+    bullets(assess.get("formative_checks", []))
+    w(f"**Exit ticket:** {assess.get('exit_ticket','')}\n")
+    w("**Rubric points**\n")
+    bullets(assess.get("rubric_points", []))
 
-    out.append("## Common Misconceptions & Fixes")
-    out.append(bullets(plan.get("misconceptions_and_fixes", [])))
+    w("## Common Misconceptions & Fixes\n")
+    bullets(plan.get("misconceptions_and_fixes", []))
 
-    out.append("## Blackboard Notes")
-    out.append(bullets(plan.get("blackboard_notes", [])))
+    w("## Blackboard Notes\n")
+    bullets(plan.get("blackboard_notes", []))
 
-    out.append("## Home Connection")
-    out.append(bullets(plan.get("home_connection", [])))
+    w("## Home Connection\n")
+    bullets(plan.get("home_connection", []))
 
-    out.append("## Teacher Tips")
-    out.append(bullets(plan.get("teacher_tips", [])))
+    w("## Teacher Tips\n")
+    bullets(plan.get("teacher_tips", []), sep="")
 
-    return "\n".join(out)
+    return "".join(buf)
 
 
 # =============== LLM CLIENTS ===============
-def mistral_api_chat(system_prompt: str, user_prompt: str) -> str:
-    """Call official Mistral API (chat-like)."""
+# One pooled client for both backends, so topics reuse connections instead of paying a
+# TCP+TLS handshake each; HTTP/2 (when h2 is installed) multiplexes concurrent calls
+HTTP_CLIENT = httpx.AsyncClient(
+    http2=importlib.util.find_spec("h2") is not None,
+    limits=httpx.Limits(max_keepalive_connections=32),
+    timeout=LLM_TIMEOUT
+)
+
+async def mistral_api_chat(system_prompt: str, user_prompt: str, model: str = MISTRAL_MODEL) -> str:
+    """Call official Mistral API (chat-like, streamed) on the shared async client."""
     if not MISTRAL_API_KEY:
         raise RuntimeError("Set MISTRAL_API_KEY for BACKEND=mistral.")
-    import httpx
     url = "https://api.mistral.ai/v1/chat/completions"
     headers = {
         "Authorization": f"Bearer {MISTRAL_API_KEY}",
         "Content-Type": "application/json",
     }
     payload = {
-        "model": MISTRAL_MODEL,
+        "model": model,
         "messages": [
             {"role": "system", "content": system_prompt},
             {"role": "user", "content": user_prompt},
@@ -183,185 +254,362 @@ def mistral_api_chat(system_prompt: str, user_prompt: str) -> str:
         "temperature": TEMPERATURE,
         "top_p": TOP_P,
         "max_tokens": MAX_TOKENS,
+        "response_format": {"type": "json_object"},  # server-side constrained JSON
     }
-    with httpx.Client(timeout=120) as client:
-        r = client.post(url, headers=headers, json=payload)
+    # Stream SSE frames and stop as soon as the top-level JSON object closes (or turns out not to be JSON)
+    parts = []
+    scanner = JsonObjectScanner()
+    async with HTTP_CLIENT.stream("POST", url, headers=headers, json={**payload, "stream": True}) as r:
         r.raise_for_status()
-        data = r.json()
-        return data["choices"][0]["message"]["content"]
-
-
-def ollama_generate(prompt: str, model: str = OLLAMA_MODEL) -> str:
-    """Call local Ollama generate endpoint."""
+        async for line in r.aiter_lines():
+            if not line.startswith("data: "):
+                continue
+            data = line[len("data: "):]
+            if data == "[DONE]":
+                break
+            delta = orjson.loads(data)["choices"][0]["delta"].get("content")
+            if delta:
+                parts.append(delta)
+                scanner.feed(delta)
+                if scanner.done:
+                    break
+    text = "".join(parts)
+    if scanner.end is not None:
+        return text[scanner.start:scanner.end]
+    return text
+
+
+async def ollama_generate(prompt: str, model: str = OLLAMA_MODEL) -> str:
+    """Call local Ollama generate endpoint (streamed) on the shared async client."""
     url = f"{OLLAMA_HOST}/api/generate"
     payload = {
         "model": model,
-        "prompt": f"{SYSTEM_PROMPT}\n\n{prompt}",
+        # Fixed system prompt + template scaffolding come first, so Ollama reuses their KV cache
+        # across topics and only evaluates the varying CONTEXT / TOPIC TEXT tail
+        "system": SYSTEM_PROMPT,
+        "prompt": prompt,
+        "format": "json",  # constrain output to valid JSON
+        "keep_alive": OLLAMA_KEEP_ALIVE,
         "options": {
             "temperature": TEMPERATURE,
             "top_p": TOP_P,
         }
     }
-    r = requests.post(url, json=payload, timeout=600, stream=True)
-    r.raise_for_status()
-    # stream returns JSON lines with {"response": "...", "done": bool}
+    # stream returns JSON lines with {"response": "...", "done": bool}; split raw reads on
+    # newlines ourselves and hand the bytes straight to orjson
     full = []
-    for line in r.iter_lines():
-        if not line:
-            continue
-        chunk = json.loads(line.decode("utf-8"))
-        if "response" in chunk:
-            full.append(chunk["response"])
+    buf = bytearray()
+    async with HTTP_CLIENT.stream("POST", url, json=payload, timeout=600) as r:
+        r.raise_for_status()
+        async for data in r.aiter_bytes():
+            buf += data
+            start = 0
+            while (nl := buf.find(b"\n", start)) >= 0:
+                line = buf[start:nl]
+                start = nl + 1
+                if line.strip():
+                    full.append(orjson.loads(line).get("response", ""))
+            del buf[:start]
+    if buf.strip():
+        full.append(orjson.loads(buf).get("response", ""))
     return "".join(full)
 
 
-def call_llm(system_prompt: str, user_prompt: str) -> str:
-    if BACKEND == "mistral":
-        return mistral_api_chat(system_prompt, user_prompt)
-    elif BACKEND == "ollama":
-        return ollama_generate(user_prompt)
-    else:
-        raise ValueError("BACKEND must be 'mistral' or 'ollama'.")
+class IntervalLimiter:
+    """Spaces requests evenly to at most `rpm` per minute (fallback when aiolimiter isn't installed)."""
+    def __init__(self, rpm: int):
+        self.interval = 60.0 / rpm
+        self._next_at = 0.0
+        self._lock = asyncio.Lock()
+
+    async def __aenter__(self):
+        async with self._lock:
+            now = time.monotonic()
+            delay = self._next_at - now
+            self._next_at = max(now, self._next_at) + self.interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def __aexit__(self, *exc):
+        return False
+
+
+def make_limiter(rpm: int):
+    if rpm <= 0:
+        return contextlib.nullcontext()
+    if AsyncLimiter is not None:
+        return AsyncLimiter(rpm, 60)
+    return IntervalLimiter(rpm)
+
+
+def model_id(model: str) -> str:
+    return f"{BACKEND}:{model}"
+
+
+@functools.lru_cache(maxsize=1)
+def get_tokenizer():
+    """cl100k_base approximates the Mistral tokenizer closely enough for a length budget."""
+    return tiktoken.get_encoding("cl100k_base") if tiktoken is not None else None
+
+
+def prepare_topic_text(text: str, max_tokens: int = MAX_TOPIC_TOKENS):
+    """Returns (text truncated to the token budget, its token count)."""
+    enc = get_tokenizer()
+    if enc is None:
+        text = text[:MAX_TOPIC_CHARS]
+        return text, len(text) // 4  # ~4 characters per token
+    tokens = enc.encode(text)
+    if len(tokens) > max_tokens:
+        return enc.decode(tokens[:max_tokens]), max_tokens
+    return text, len(tokens)
+
+
+def choose_model(n_tokens: int) -> str:
+    if BACKEND != "mistral":
+        return OLLAMA_MODEL
+    return MISTRAL_SMALL_MODEL if n_tokens < SMALL_TOPIC_TOKENS else MISTRAL_MODEL
+
+
+async def call_llm(limiter, system_prompt: str, user_prompt: str, model: str) -> str:
+    async with limiter:
+        if BACKEND == "mistral":
+            return await mistral_api_chat(system_prompt, user_prompt, model)
+        elif BACKEND == "ollama":
+            return await ollama_generate(user_prompt, model)
+        else:
+            raise ValueError("BACKEND must be 'mistral' or 'ollama'.")
 
 
 # =============== FIRESTORE HELPERS ===============
-def iter_topics(
+def iter_topic_collections(
     class_name: Optional[str] = None,
     subject: Optional[str] = None,
     chapter: Optional[str] = None
 ):
     """
-    Yields (class_doc_id, subject_doc_id, chapter_doc_id, topic_doc_ref, topic_doc_dict)
-    according to the filters provided. If none provided, processes ALL.
+    Yields the topics collections matching the filters. Filtered levels are addressed directly;
+    unfiltered ones are listed with list_documents(), which also returns parent docs that only
+    exist as paths (the splitter writes topics without creating class/subject/chapter docs).
     """
     classes_ref = db.collection(ROOT_COLLECTION)
+    class_refs = [classes_ref.document(class_name)] if class_name else classes_ref.list_documents()
+    for class_ref in class_refs:
+        subjects_ref = class_ref.collection("subjects")
+        subject_refs = [subjects_ref.document(subject)] if subject else subjects_ref.list_documents()
+        for subject_ref in subject_refs:
+            chapters_ref = subject_ref.collection("chapters")
+            chapter_refs = [chapters_ref.document(chapter)] if chapter else chapters_ref.list_documents()
+            for chapter_ref in chapter_refs:
+                yield chapter_ref.collection("topics")
 
-    class_query = [classes_ref.document(class_name)] if class_name else classes_ref.stream()
-    for cdoc in ( [classes_ref.document(class_name).get()] if class_name else class_query ):
-        cdoc_obj = cdoc if class_name else cdoc
-        if class_name:
-            if not cdoc_obj.exists:
-                continue
-        class_id = cdoc.id if hasattr(cdoc, "id") else class_name
-
-        subjects_ref = classes_ref.document(class_id).collection("subjects")
-        subj_query = [subjects_ref.document(subject)] if subject else subjects_ref.stream()
-
-        for sdoc in ( [subjects_ref.document(subject).get()] if subject else subj_query ):
-            if subject and not sdoc.exists:
-                continue
-            subject_id = sdoc.id if hasattr(sdoc, "id") else subject
-
-            chapters_ref = subjects_ref.document(subject_id).collection("chapters")
-            chap_query = [chapters_ref.document(chapter)] if chapter else chapters_ref.stream()
-
-            for chdoc in ( [chapters_ref.document(chapter).get()] if chapter else chap_query ):
-                if chapter and not chdoc.exists:
-                    continue
-                chapter_id = chdoc.id if hasattr(chdoc, "id") else chapter
-
-                topics_ref = chapters_ref.document(chapter_id).collection("topics")
-                for tdoc in topics_ref.stream():
-                    yield class_id, subject_id, chapter_id, tdoc.reference, tdoc.to_dict()
 
+def iter_topics(
+    class_name: Optional[str] = None,
+    subject: Optional[str] = None,
+    chapter: Optional[str] = None
+):
+    """
+    Yields (class_doc_id, subject_doc_id, chapter_doc_id, topic_doc_ref, topic_doc_dict)
+    according to the filters provided. If none provided, processes ALL with a single
+    collection-group query.
+    """
+    if class_name or subject or chapter:
+        topic_docs = (
+            tdoc
+            for topics_ref in iter_topic_collections(class_name, subject, chapter)
+            for tdoc in topics_ref.select(TOPIC_FIELDS).stream()
+        )
+    else:
+        topic_docs = db.collection_group("topics").select(TOPIC_FIELDS).stream()
 
-def safe_parse_json(s: str) -> Optional[Dict[str, Any]]:
-    try:
-        return json.loads(s)
-    except Exception:
-        # try to trim common JSON noise (e.g., markdown fences)
-        s2 = s.strip().strip("`").strip()
-        try:
-            return json.loads(s2)
-        except Exception:
-            return None
+    for tdoc in topic_docs:
+        # The collection group spans every "topics" collection in the project; keep only
+        # classes/{class}/subjects/{subject}/chapters/{chapter}/topics/{topic}
+        parts = tdoc.reference.path.split("/")
+        if len(parts) != 8 or parts[0] != ROOT_COLLECTION or parts[2] != "subjects" or parts[4] != "chapters":
+            continue
+        yield parts[1], parts[3], parts[5], tdoc.reference, tdoc.to_dict()
 
 
 # =============== MAIN LOGIC ===============
-def generate_plan_for_topic(
+async def generate_plan_for_topic(
+    limiter,
     class_name: str,
     subject: str,
     chapter: str,
     topic_title: str,
     topic_text: str
 ) -> Dict[str, Any]:
-    user_prompt = USER_PROMPT_TEMPLATE.format(
+    topic_text, n_tokens = prepare_topic_text(topic_text)  # guardrail for very long texts
+    model = choose_model(n_tokens)
+    user_prompt = render_user_prompt(
         class_name=class_name,
         subject=subject,
         chapter=chapter,
         topic_title=topic_title,
-        topic_text=topic_text[:12000]  # guardrail for very long texts
+        topic_text=topic_text
     )
 
-    raw = call_llm(SYSTEM_PROMPT, user_prompt)
+    # Only parsed plans are cached: a raw response that failed to parse would otherwise be replayed on
+    # every rerun, so a topic that failed both attempts could never succeed until the entry expired
+    plan_key = llm_cache.make_key("plan", model_id(model), TEMPERATURE, SYSTEM_PROMPT, user_prompt)
+    cached_plan = llm_cache.get(plan_key)
+    if cached_plan is not None:
+        plan = orjson.loads(cached_plan)
+        return {"plan_json": plan, "model": model}
+
+    raw = await call_llm(limiter, SYSTEM_PROMPT, user_prompt, model)
     plan = safe_parse_json(raw)
 
     if not plan:
-        # Fallback: ask for JSON again succinctly
+        # Deep fallback (both backends already constrain output to JSON): ask again succinctly
         retry_prompt = (
             user_prompt +
             "\n\nYour previous output was not valid JSON. "
             "Return ONLY valid JSON now, no explanations."
         )
-        raw = call_llm(SYSTEM_PROMPT, retry_prompt)
+        raw = await call_llm(limiter, SYSTEM_PROMPT, retry_prompt, model)
         plan = safe_parse_json(raw)
 
     if not plan:
         raise ValueError("Model did not return valid JSON after retry.")
+    llm_cache.set(plan_key, orjson.dumps(plan).decode())
+    return {"plan_json": plan, "model": model}
 
-    # also create a markdown version for teacher readability
-    plan_md = plan_json_to_markdown(plan)
-    return {"plan_json": plan, "plan_markdown": plan_md}
 
+def plan_update(plan_bundle: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "ai_plan_json": plan_bundle["plan_json"],
+        "ai_model": model_id(plan_bundle["model"]),
+        "ai_timestamp": firestore.SERVER_TIMESTAMP,
+    }
 
-def save_plan_to_topic(topic_ref, plan_bundle: Dict[str, Any]):
-    topic_ref.set(
-        {
-            "ai_plan_json": plan_bundle["plan_json"],
-            "ai_plan_markdown": plan_bundle["plan_markdown"],
-            "ai_model": f"{BACKEND}:{MISTRAL_MODEL if BACKEND=='mistral' else OLLAMA_MODEL}",
-            "ai_timestamp": firestore.SERVER_TIMESTAMP,
-        },
-        merge=True
-    )
 
+def plan_markdown(topic_doc: Dict[str, Any]) -> Optional[str]:
+    """Teacher-readable Markdown for a topic's plan, rendered on read (older docs stored it)."""
+    if topic_doc.get("ai_plan_markdown"):
+        return topic_doc["ai_plan_markdown"]
+    if topic_doc.get("ai_plan_json"):
+        return plan_json_to_markdown(topic_doc["ai_plan_json"])
+    return None
 
-def main():
-    parser = argparse.ArgumentParser(description="Generate teaching plans from Firestore topics via Mistral.")
-    parser.add_argument("--class", dest="class_name", help="Class doc id (e.g., Class1)")
-    parser.add_argument("--subject", dest="subject", help="Subject doc id (e.g., English)")
-    parser.add_argument("--chapter", dest="chapter", help="Chapter doc id (e.g., Chapter1)")
-    parser.add_argument("--sleep", type=float, default=0.8, help="Sleep seconds between requests to be polite")
-    args = parser.parse_args()
 
-    count = 0
-    for class_id, subject_id, chapter_id, topic_ref, topic_doc in iter_topics(
-        class_name=args.class_name, subject=args.subject, chapter=args.chapter
-    ):
-        title = str(topic_doc.get("title", topic_ref.id))
-        content = str(topic_doc.get("content", "")).strip()
+def commit_plans(plans) -> None:
+    """Save [(topic_ref, plan_bundle), ...] in one WriteBatch, retrying transient errors with backoff."""
+    for attempt in range(COMMIT_RETRIES + 1):
+        batch = db.batch()
+        for topic_ref, plan_bundle in plans:
+            batch.set(topic_ref, plan_update(plan_bundle), merge=True)
+        try:
+            batch.commit()
+            return
+        except TRANSIENT_ERRORS:
+            if attempt == COMMIT_RETRIES:
+                raise
+            time.sleep(2 ** attempt)
+
+
+async def plan_writer(queue: asyncio.Queue) -> int:
+    """Drain finished plans from queue into batched commits until a None sentinel; returns topics saved."""
+    saved = 0
+    pending = []
+    while True:
+        item = await queue.get()
+        if item is not None:
+            pending.append(item)
+        # Commit whatever has accumulated while the previous commit was in flight
+        if pending and (item is None or len(pending) >= FIRESTORE_BATCH_SIZE or queue.empty()):
+            try:
+                await asyncio.to_thread(commit_plans, pending)
+                saved += len(pending)
+            except Exception as e:
+                for topic_ref, _ in pending:
+                    print(f"Failed to save {topic_ref.path}: {e}")
+            pending = []
+        if item is None:
+            return saved
+
+
+def feed_topics(loop: asyncio.AbstractEventLoop, work: asyncio.Queue, args, n_workers: int) -> None:
+    """Producer (runs in a thread): stream topics from Firestore into work, then one None per worker."""
+    try:
+        for class_id, subject_id, chapter_id, topic_ref, topic_doc in iter_topics(
+            class_name=args.class_name, subject=args.subject, chapter=args.chapter
+        ):
+            title = str(topic_doc.get("title", topic_ref.id))
+            content = str(topic_doc.get("content", "")).strip()
+
+            if not content:
+                print(f"Skip (no content): {class_id}/{subject_id}/{chapter_id}/{topic_ref.id}")
+                continue
 
-        if not content:
-            print(f"Skip (no content): {class_id}/{subject_id}/{chapter_id}/{topic_ref.id}")
-            continue
+            # Skip if already generated (optional)
+            if topic_doc.get("ai_timestamp"):
+                print(f"Already has ai_plan_json: {class_id}/{subject_id}/{chapter_id}/{topic_ref.id}")
+                continue
 
-        # Skip if already generated (optional)
-        if topic_doc.get("ai_plan_json"):
-            print(f"Already has ai_plan_json: {class_id}/{subject_id}/{chapter_id}/{topic_ref.id}")
-            continue
+            job = (class_id, subject_id, chapter_id, topic_ref, title, content)
+            asyncio.run_coroutine_threadsafe(work.put(job), loop).result()
+    finally:
+        for _ in range(n_workers):
+            asyncio.run_coroutine_threadsafe(work.put(None), loop).result()
 
+
+async def topic_worker(limiter, work: asyncio.Queue, plans: asyncio.Queue) -> None:
+    """Consumer: generate plans for queued topics and hand them to the writer until a None sentinel."""
+    while True:
+        job = await work.get()
+        if job is None:
+            return
+        class_id, subject_id, chapter_id, topic_ref, title, content = job
         print(f"Generating: {class_id}/{subject_id}/{chapter_id}/{title}")
         try:
-            plan_bundle = generate_plan_for_topic(class_id, subject_id, chapter_id, title, content)
-            save_plan_to_topic(topic_ref, plan_bundle)
-            count += 1
+            plan_bundle = await generate_plan_for_topic(limiter, class_id, subject_id, chapter_id, title, content)
+            await plans.put((topic_ref, plan_bundle))
         except Exception as e:
             print(f"Failed for {topic_ref.path}: {e}")
 
-        time.sleep(args.sleep)
+
+async def main_async(args):
+    # Firestore is read in a thread while --concurrency workers call the LLM (capped at --rpm),
+    # so the topic stream keeps moving during multi-second generations
+    limiter = make_limiter(args.rpm)
+    work = asyncio.Queue(maxsize=WORK_QUEUE_SIZE)
+    plans = asyncio.Queue()
+    writer = asyncio.create_task(plan_writer(plans))
+    workers = [asyncio.create_task(topic_worker(limiter, work, plans)) for _ in range(args.concurrency)]
+    try:
+        await asyncio.to_thread(feed_topics, asyncio.get_running_loop(), work, args, len(workers))
+    finally:
+        # Even when feed_topics raises it queues every worker's sentinel, so this waits only for the
+        # topics already in flight; the client is closed and the writer stopped after they are saved
+        await asyncio.gather(*workers, return_exceptions=True)
+        await HTTP_CLIENT.aclose()
+        await plans.put(None)
+        count = await writer
 
     print(f"Done. Generated plans for {count} topic(s).")
 
 
+def main():
+    parser = argparse.ArgumentParser(description="Generate teaching plans from Firestore topics via Mistral.")
+    parser.add_argument("--class", dest="class_name", help="Class doc id (e.g., Class1)")
+    parser.add_argument("--subject", dest="subject", help="Subject doc id (e.g., English)")
+    parser.add_argument("--chapter", dest="chapter", help="Chapter doc id (e.g., Chapter1)")
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY, help="Topics generated in parallel")
+    parser.add_argument("--rpm", type=int, default=DEFAULT_RPM, help="Max LLM requests per minute, to be polite")
+    parser.add_argument("--markdown", metavar="TOPIC_PATH",
+                        help="Print the stored plan of one topic doc as Markdown and exit "
+                             "(e.g., classes/Class1/subjects/English/chapters/Chapter1/topics/Topic1)")
+    args = parser.parse_args()
+
+    if args.markdown:
+        topic_doc = db.document(args.markdown).get().to_dict() or {}
+        print(plan_markdown(topic_doc) or f"No plan stored for {args.markdown}")
+        return
+
+    asyncio.run(main_async(args))
+
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,52 @@
+"""
+Persistent prompt -> response cache for LLM calls
+
+A single sqlite table (WAL mode) keyed by a SHA-256 of everything that determines
+a response, so re-running generateplan.py after an interruption or failure doesn't
+re-send prompts that were already answered.
+"""
+
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+from typing import Optional
+
+CACHE_PATH = os.getenv("LLM_CACHE_PATH", ".llm_cache.sqlite")
+DEFAULT_TTL = 7 * 24 * 3600  # 7 days
+
+_conn: Optional[sqlite3.Connection] = None
+_lock = threading.Lock()
+
+
+def _connect() -> sqlite3.Connection:
+    global _conn
+    if _conn is None:
+        _conn = sqlite3.connect(CACHE_PATH, check_same_thread=False, isolation_level=None)
+        _conn.execute("PRAGMA journal_mode=WAL")
+        _conn.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value BLOB, expires INTEGER)")
+    return _conn
+
+
+def make_key(*parts) -> str:
+    """SHA-256 cache key over the given parts, e.g. (backend, model, temperature, system, user)."""
+    return hashlib.sha256(":".join(str(part) for part in parts).encode("utf-8")).hexdigest()
+
+
+def get(key: str) -> Optional[str]:
+    """Cached value for key, or None if missing or expired."""
+    with _lock:
+        row = _connect().execute("SELECT value, expires FROM cache WHERE key = ?", (key,)).fetchone()
+    if row is None or row[1] < time.time():
+        return None
+    return row[0]
+
+
+def set(key: str, value: str, ttl: int = DEFAULT_TTL) -> None:
+    """Store value under key for ttl seconds."""
+    with _lock:
+        _connect().execute(
+            "INSERT OR REPLACE INTO cache (key, value, expires) VALUES (?, ?, ?)",
+            (key, value, int(time.time()) + ttl)
+        )
@@ -0,0 +1,91 @@
+"""
+JSON salvage for LLM output
+
+Models asked for JSON still sometimes wrap it in ```json fences or surround it with
+commentary. safe_parse_json recovers the object in those cases so callers only fall
+back to a retry prompt when there is genuinely no JSON object in the response.
+"""
+
+import re
+from typing import Any, Dict, Optional
+
+import orjson
+
+# Leading ```json / ``` fence and trailing ``` fence around model output
+FENCE_RE = re.compile(r"^```(?:json)?\s*|\s*```$")
+
+
+class JsonObjectScanner:
+    """Incrementally tracks the top-level JSON object in streamed model output."""
+    def __init__(self):
+        self.start = None  # offset of the opening "{"
+        self.end = None  # offset just past its matching "}"
+        self.corrupt = False  # prose (not a fence or "{") before the object
+        self._pos = 0
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+
+    @property
+    def done(self) -> bool:
+        return self.corrupt or self.end is not None
+
+    def feed(self, text: str) -> None:
+        for ch in text:
+            pos = self._pos
+            self._pos += 1
+            if self.start is None:
+                if ch == "{":
+                    self.start, self._depth = pos, 1
+                elif not (ch.isspace() or ch in "`json"):
+                    self.corrupt = True
+                    return
+            elif self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+            elif ch == '"':
+                self._in_string = True
+            elif ch in "{[":
+                self._depth += 1
+            elif ch in "}]":
+                self._depth -= 1
+                if self._depth == 0:
+                    self.end = pos + 1
+                    return
+
+
+def extract_json_object(s: str) -> Optional[str]:
+    """Slice from the first "{" to its matching "}", skipping braces inside strings."""
+    start = s.find("{")
+    if start < 0:
+        return None
+    scanner = JsonObjectScanner()
+    scanner.feed(s[start:])
+    if scanner.end is None:
+        return None
+    return s[start:start + scanner.end]
+
+
+def safe_parse_json(s: str) -> Optional[Dict[str, Any]]:
+    """Parsed JSON from model output, or None when no JSON object can be recovered."""
+    try:
+        return orjson.loads(s)
+    except Exception:
+        pass
+    # trim markdown fences, then fall back to the balanced object amid narrative/commentary
+    s2 = FENCE_RE.sub("", s.strip())
+    try:
+        return orjson.loads(s2)
+    except Exception:
+        pass
+    obj = extract_json_object(s2)
+    if obj is None:
+        return None
+    try:
+        return orjson.loads(obj)
+    except Exception:
+        return None
@@ -1,17 +1,36 @@
 import streamlit as st
-import pdfplumber
-from PyPDF2 import PdfReader, PdfWriter
+from PyPDF2 import PdfReader
 import re
 import io
-import json
 import time
-from typing import Dict, Any, Optional
+import asyncio
+import hashlib
+import functools
+from typing import Dict, Any, Optional, Callable, Iterator, Tuple
+from concurrent.futures import ThreadPoolExecutor
 import os
 import requests
+from requests.adapters import HTTPAdapter
+import httpx
+import orjson
+
+import llm_cache
+from llm_json import safe_parse_json
 
 import firebase_admin
 from firebase_admin import credentials, firestore
 
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# Optional: google-re2 (DFA, no backtracking) scans each page for topic headers in linear time
+try:
+    import re2
+except ImportError:
+    re2 = None
+
 # ---------------- PAGE CONFIG (must be first Streamlit call) ----------------
 st.set_page_config(page_title="NCERT AI Teaching Assistant", layout="wide", page_icon="📚")
 
@@ -21,6 +40,16 @@ OLLAMA_MODEL = os.getenv("OLLAMA_MODEL", "mistral")
 MAX_TOKENS = 2048
 TEMPERATURE = 0.3
 TOP_P = 0.9
+# "Generate All Plans" keeps this many Ollama requests in flight; start the server with
+# OLLAMA_NUM_PARALLEL >= this value (e.g. `OLLAMA_NUM_PARALLEL=4 ollama serve`) so they run concurrently
+OLLAMA_NUM_PARALLEL = int(os.getenv("OLLAMA_NUM_PARALLEL", "4"))
+
+# Topic text budget per prompt; the character cap is used when tiktoken is not installed
+MAX_TOPIC_TOKENS = 3000
+MAX_TOPIC_CHARS = 12000
+
+# Firestore commits at most 500 writes per batch
+FIRESTORE_BATCH_LIMIT = 500
 
 # ---------------- FIREBASE SETUP ----------------
 @st.cache_resource
@@ -63,12 +92,14 @@ def get_db_client():
     return db
 
 # ---------------- REGEX PATTERNS ----------------
-TOPIC_REGEX = re.compile(
-    r"(Two Little Hands|Parts of the Body|Let us [A-Za-z]+|Picture\s+(Talk|Time)|"
-    r"Sight words|New words|Alphabet song|Letter sounds|Odd One Out|Note to the teacher)",
-    re.IGNORECASE
+# Case-insensitivity is an inline flag so the same pattern compiles under re2 and re
+TOPIC_REGEX = (re2 or re).compile(
+    r"(?i)(Two Little Hands|Parts of the Body|Let us [A-Za-z]+|Picture\s+(Talk|Time)|"
+    r"Sight words|New words|Alphabet song|Letter sounds|Odd One Out|Note to the teacher)"
 )
-MERGE_WITH_PREVIOUS = {"sight words", "new words", "note to the teacher"}
+# Already case-folded; compared against the casefolded header
+MERGE_WITH_PREVIOUS = frozenset({"sight words", "new words", "note to the teacher"})
+_WS_RE = re.compile(r"\s+")
 
 # ---------------- AI PROMPTS ----------------
 SYSTEM_PROMPT = (
@@ -123,225 +154,400 @@ TOPIC TEXT:
 \"\"\"{topic_text}\"\"\"
 """
 
+# Split once at load: the instructions/schema before CONTEXT: are constant (braces unescaped here),
+# so each call only formats the short CONTEXT block and concatenates the topic text and tail
+_schema, _marker, _context = USER_PROMPT_TEMPLATE.partition("CONTEXT:")
+_USER_PROMPT_HEAD = _schema.replace("{{", "{").replace("}}", "}") + _marker
+_USER_PROMPT_CONTEXT, _USER_PROMPT_TAIL = _context.rsplit("{topic_text}", 1)
+
 # ---------------- AI FUNCTIONS ----------------
-def call_ollama_api(prompt: str) -> str:
-    import requests
-    url = f"{OLLAMA_HOST}/api/generate"
-    full_prompt = f"{SYSTEM_PROMPT}\n\n{prompt}"
-    payload = {
+@st.cache_resource
+def get_http_session() -> requests.Session:
+    """One keep-alive session shared across reruns for Ollama calls and probes"""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=10, pool_maxsize=10, max_retries=0)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.headers.update({"Accept-Encoding": "gzip, deflate", "Connection": "keep-alive"})
+    return session
+
+def ollama_payload(prompt: str) -> Dict[str, Any]:
+    return {
         "model": OLLAMA_MODEL,
-        "prompt": full_prompt,
+        "prompt": f"{SYSTEM_PROMPT}\n\n{prompt}",
         "options": {
             "temperature": TEMPERATURE,
             "top_p": TOP_P,
         },
         "stream": False
     }
+
+OLLAMA_PROBE_TTL = 30
+
+@st.cache_data(ttl=OLLAMA_PROBE_TTL, show_spinner=False)
+def probe_ollama():
+    """(/api/version status, installed model names or None), cached so reruns don't re-probe;
+    raises when the server is unreachable (errors are not cached)"""
+    session = get_http_session()
+    response = session.get(f"{OLLAMA_HOST}/api/version", timeout=2)
+    if response.status_code != 200:
+        return response.status_code, None
+    models_response = session.get(f"{OLLAMA_HOST}/api/tags", timeout=5)
+    if models_response.status_code != 200:
+        return response.status_code, None
+    models = orjson.loads(models_response.content).get("models", [])
+    return response.status_code, [m["name"] for m in models]
+
+# Payloads are pre-encoded with orjson rather than via the clients' stdlib-json `json=` kwarg
+JSON_HEADERS = {"Content-Type": "application/json"}
+
+# Streamed single-topic calls: connect timeout, then max silence between NDJSON chunks
+OLLAMA_STREAM_TIMEOUT = (10, 300)
+
+def call_ollama_api(prompt: str, on_text: Optional[Callable[[str], None]] = None) -> str:
+    """Stream /api/generate and return the full response; on_text(piece) is called as each chunk arrives"""
+    url = f"{OLLAMA_HOST}/api/generate"
+    body = orjson.dumps({**ollama_payload(prompt), "stream": True})
+    buf = io.StringIO()
     try:
-        response = requests.post(url, json=payload, timeout=300)
-        response.raise_for_status()
-        data = response.json()
-        return data.get("response", "")
+        with get_http_session().post(url, data=body, headers=JSON_HEADERS, stream=True,
+                                     timeout=OLLAMA_STREAM_TIMEOUT) as response:
+            response.raise_for_status()
+            for line in response.iter_lines():
+                if not line:
+                    continue
+                chunk = orjson.loads(line)
+                piece = chunk.get("response", "")
+                buf.write(piece)
+                if on_text is not None:
+                    on_text(piece)
+                if chunk.get("done"):
+                    break
+        return buf.getvalue()
     except requests.exceptions.RequestException as e:
         raise RuntimeError(f"Ollama API call failed: {e}")
     except Exception as e:
         raise RuntimeError(f"Error processing Ollama response: {e}")
 
-def safe_parse_json(s: str) -> Optional[Dict[str, Any]]:
+async def acall_ollama_api(client: httpx.AsyncClient, prompt: str) -> str:
+    """Async call_ollama_api on a shared client, so several topics can be generated at once"""
+    url = f"{OLLAMA_HOST}/api/generate"
     try:
-        return json.loads(s)
-    except Exception:
-        s2 = s.strip().strip("`").strip()
-        try:
-            return json.loads(s2)
-        except Exception:
-            return None
+        body = orjson.dumps(ollama_payload(prompt))
+        response = await client.post(url, content=body, headers=JSON_HEADERS, timeout=300)
+        response.raise_for_status()
+        data = orjson.loads(response.content)
+        return data.get("response", "")
+    except httpx.HTTPError as e:
+        raise RuntimeError(f"Ollama API call failed: {e}")
+    except Exception as e:
+        raise RuntimeError(f"Error processing Ollama response: {e}")
 
 def plan_json_to_markdown(plan: Dict[str, Any]) -> str:
-    def bullets(items) -> str:
-        return "".join(f"- {it}\n" for it in items) if items else ""
-    out = []
-    out.append(f"# {plan.get('title', 'Teaching Plan')}")
-    out.append(f"**Estimated Duration:** {plan.get('estimated_duration_min', '-')} minutes\n")
-    out.append("## Learning Objectives")
-    out.append(bullets(plan.get("learning_objectives", [])))
-    out.append("## Prerequisites")
-    out.append(bullets(plan.get("prerequisites", [])))
-    out.append("## Key Vocabulary")
-    out.append(bullets(plan.get("key_vocabulary", [])))
-    out.append("## Materials Needed")
-    out.append(bullets(plan.get("materials_needed", [])))
-    out.append("## Engagement & Warmup")
-    for step in plan.get("engage_warmup", []):
-        if isinstance(step, dict):
-            out.append(f"- **Step {step.get('step', '')}:** {step.get('instruction', '')}")
-        else:
-            out.append(f"- {step}")
-    out.append("\n## Explicit Instruction")
-    for step in plan.get("explicit_instruction", []):
-        if isinstance(step, dict):
-            out.append(f"- **Step {step.get('step', '')}:** {step.get('instruction', '')}")
-        else:
-            out.append(f"- {step}")
-    out.append("\n## Guided Practice")
-    for step in plan.get("guided_practice", []):
-        if isinstance(step, dict):
-            out.append(f"- **Step {step.get('step', '')}:** {step.get('instruction', '')}")
-        else:
-            out.append(f"- {step}")
-    out.append("\n## Independent Practice")
-    for task in plan.get("independent_practice", []):
+    buf = io.StringIO()
+    w = buf.write
+
+    def write_bullets(items):
+        for it in items or ():
+            w(f"- {it}\n")
+        w("\n")
+
+    def write_steps(steps):
+        for step in steps or ():
+            if isinstance(step, dict):
+                w(f"- **Step {step.get('step', '')}:** {step.get('instruction', '')}\n")
+            else:
+                w(f"- {step}\n")
+
+    get = plan.get
+    diff = get("differentiation") or {}
+    assess = get("assessment") or {}
+
+    w(f"# {get('title', 'Teaching Plan')}\n")
+    w(f"**Estimated Duration:** {get('estimated_duration_min', '-')} minutes\n\n")
+    w("## Learning Objectives\n")
+    write_bullets(get("learning_objectives"))
+    w("## Prerequisites\n")
+    write_bullets(get("prerequisites"))
+    w("## Key Vocabulary\n")
+    write_bullets(get("key_vocabulary"))
+    w("## Materials Needed\n")
+    write_bullets(get("materials_needed"))
+    w("## Engagement & Warmup\n")
+    write_steps(get("engage_warmup"))
+    w("\n## Explicit Instruction\n")
+    write_steps(get("explicit_instruction"))
+    w("\n## Guided Practice\n")
+    write_steps(get("guided_practice"))
+    w("\n## Independent Practice\n")
+    for task in get("independent_practice") or ():
         if isinstance(task, dict):
-            out.append(f"- **Task:** {task.get('task', '')}")
-            sc = task.get("success_criteria", [])
+            w(f"- **Task:** {task.get('task', '')}\n")
+            sc = task.get("success_criteria")
             if sc:
-                out.append("  - **Success criteria:**")
-                out.extend([f"    - {c}" for c in sc])
-    out.append("\n## Differentiation")
-    diff = plan.get("differentiation", {})
-    out.append("### Support")
-    out.append(bullets(diff.get("support", [])))
-    out.append("### Challenge")
-    out.append(bullets(diff.get("challenge", [])))
-    out.append("## Assessment")
-    assess = plan.get("assessment", {})
-    out.append("### Formative Checks")
-    out.append(bullets(assess.get("formative_checks", [])))
-    out.append(f"### Exit Ticket\n{assess.get('exit_ticket', '')}\n")
-    out.append("### Rubric Points")
-    out.append(bullets(assess.get("rubric_points", [])))
-    out.append("## Common Misconceptions & Fixes")
-    out.append(bullets(plan.get("misconceptions_and_fixes", [])))
-    out.append("## Blackboard Notes")
-    out.append(bullets(plan.get("blackboard_notes", [])))
-    out.append("## Home Connection")
-    out.append(bullets(plan.get("home_connection", [])))
-    out.append("## Teacher Tips")
-    out.append(bullets(plan.get("teacher_tips", [])))
-    return "\n".join(out)
-
-def generate_teaching_plan(class_name: str, subject: str, chapter: str, topic_title: str, topic_text: str) -> Dict[str, Any]:
-    user_prompt = USER_PROMPT_TEMPLATE.format(
-        class_name=class_name,
-        subject=subject,
-        chapter=chapter,
-        topic_title=topic_title,
-        topic_text=topic_text[:12000]
-    )
-    raw = call_ollama_api(user_prompt)
+                w("  - **Success criteria:**\n")
+                for c in sc:
+                    w(f"    - {c}\n")
+    w("\n## Differentiation\n")
+    w("### Support\n")
+    write_bullets(diff.get("support"))
+    w("### Challenge\n")
+    write_bullets(diff.get("challenge"))
+    w("## Assessment\n")
+    w("### Formative Checks\n")
+    write_bullets(assess.get("formative_checks"))
+    w(f"### Exit Ticket\n{assess.get('exit_ticket', '')}\n\n")
+    w("### Rubric Points\n")
+    write_bullets(assess.get("rubric_points"))
+    w("## Common Misconceptions & Fixes\n")
+    write_bullets(get("misconceptions_and_fixes"))
+    w("## Blackboard Notes\n")
+    write_bullets(get("blackboard_notes"))
+    w("## Home Connection\n")
+    write_bullets(get("home_connection"))
+    w("## Teacher Tips\n")
+    write_bullets(get("teacher_tips"))
+    # every section above ends with a separator newline; drop the final one
+    return buf.getvalue()[:-1]
+
+@functools.lru_cache(maxsize=1)
+def get_tokenizer():
+    """cl100k_base approximates the Ollama model's tokenizer closely enough for a length budget"""
+    return tiktoken.get_encoding("cl100k_base") if tiktoken is not None else None
+
+def truncate_to_tokens(text: str, max_tokens: int = MAX_TOPIC_TOKENS) -> str:
+    enc = get_tokenizer()
+    if enc is None:
+        return text[:MAX_TOPIC_CHARS]
+    # Byte-level BPE tokens cover at least one byte, so short ASCII text can't exceed the budget;
+    # other scripts (e.g. Devanagari) can cost several tokens per character and are always encoded
+    if text.isascii() and len(text) <= max_tokens:
+        return text
+    tokens = enc.encode(text)
+    if len(tokens) <= max_tokens:
+        return text
+    return enc.decode(tokens[:max_tokens])
+
+def build_user_prompt(class_name: str, subject: str, chapter: str, topic_title: str, topic_text: str) -> str:
+    return _USER_PROMPT_HEAD + _USER_PROMPT_CONTEXT.format_map({
+        "class_name": class_name,
+        "subject": subject,
+        "chapter": chapter,
+        "topic_title": topic_title
+    }) + topic_text + _USER_PROMPT_TAIL
+
+RETRY_SUFFIX = "\n\nIMPORTANT: Return ONLY valid JSON format, no explanations or markdown."
+
+def plan_cache_key(class_name: str, subject: str, chapter: str, topic_title: str, topic_text: str) -> str:
+    """Persistent cache key for a topic's plan; the topic text enters as a short blake2b digest"""
+    text_hash = hashlib.blake2b(topic_text.encode("utf-8"), digest_size=16).hexdigest()
+    return llm_cache.make_key("ollama-plan", OLLAMA_MODEL, TEMPERATURE, class_name, subject, chapter, topic_title, text_hash)
+
+def cached_plan(key: str) -> Optional[Dict[str, Any]]:
+    """Plan bundle stored under key by an earlier run, if any"""
+    cached = llm_cache.get(key)
+    if cached is None:
+        return None
+    plan = orjson.loads(cached)
+    return {"plan_json": plan, "plan_markdown": plan_json_to_markdown(plan)}
+
+def generate_teaching_plan(class_name: str, subject: str, chapter: str, topic_title: str, topic_text: str,
+                           use_cache: bool = True, on_text: Optional[Callable[[str], None]] = None) -> Dict[str, Any]:
+    """Plan for one topic; the same topic + text is served from llm_cache instead of Ollama unless
+    use_cache is False (Regenerate), which still stores the fresh plan"""
+    key = plan_cache_key(class_name, subject, chapter, topic_title, topic_text)
+    if use_cache and (bundle := cached_plan(key)) is not None:
+        return bundle
+    # Truncated once here; the retry below reuses the same prompt
+    topic_text = truncate_to_tokens(topic_text)
+    user_prompt = build_user_prompt(class_name, subject, chapter, topic_title, topic_text)
+    raw = call_ollama_api(user_prompt, on_text)
+    plan = safe_parse_json(raw)
+    if not plan:
+        raw = call_ollama_api(user_prompt + RETRY_SUFFIX, on_text)
+        plan = safe_parse_json(raw)
+    if not plan:
+        raise ValueError("Model did not return valid JSON after retry. Raw response: " + raw[:500])
+    llm_cache.set(key, orjson.dumps(plan).decode())
+    plan_md = plan_json_to_markdown(plan)
+    return {"plan_json": plan, "plan_markdown": plan_md}
+
+async def agenerate_teaching_plan(client: httpx.AsyncClient, class_name: str, subject: str, chapter: str,
+                                  topic_title: str, topic_text: str) -> Dict[str, Any]:
+    key = plan_cache_key(class_name, subject, chapter, topic_title, topic_text)
+    if (bundle := cached_plan(key)) is not None:
+        return bundle
+    topic_text = truncate_to_tokens(topic_text)
+    user_prompt = build_user_prompt(class_name, subject, chapter, topic_title, topic_text)
+    raw = await acall_ollama_api(client, user_prompt)
     plan = safe_parse_json(raw)
     if not plan:
-        retry_prompt = user_prompt + "\n\nIMPORTANT: Return ONLY valid JSON format, no explanations or markdown."
-        raw = call_ollama_api(retry_prompt)
+        raw = await acall_ollama_api(client, user_prompt + RETRY_SUFFIX)
         plan = safe_parse_json(raw)
     if not plan:
         raise ValueError("Model did not return valid JSON after retry. Raw response: " + raw[:500])
+    llm_cache.set(key, orjson.dumps(plan).decode())
     plan_md = plan_json_to_markdown(plan)
     return {"plan_json": plan, "plan_markdown": plan_md}
 
 # ---------------- PDF PROCESSING ----------------
-def split_pdf_by_topics(pdf_file):
-    topics = []
+def split_pdf_by_topics(pdf_file, on_page: Optional[Callable[[int, int], None]] = None) -> Iterator[Tuple[str, str]]:
+    """Yield (filename, text) for each topic as soon as its last page is read; on_page(done, total)
+    is called after every page"""
     reader = PdfReader(pdf_file)
-    with pdfplumber.open(pdf_file) as pdf:
-        current_topic = None
-        topic_writer = PdfWriter()
-        topic_count = 0
-        topic_text = []
-        for i, page in enumerate(pdf.pages):
-            text = page.extract_text() or ""
-            match = TOPIC_REGEX.search(text)
-            if match:
-                header_text = match.group(0).strip()
-                normalized = header_text.lower()
-                if normalized in MERGE_WITH_PREVIOUS and current_topic is not None:
-                    pass
-                else:
-                    if current_topic is not None and len(topic_writer.pages) > 0:
-                        pdf_bytes = io.BytesIO()
-                        topic_writer.write(pdf_bytes)
-                        pdf_bytes.seek(0)
-                        full_text = "\n".join(topic_text).strip()
-                        topics.append((f"{topic_count:02d}_{current_topic}.pdf", pdf_bytes, full_text))
-                        topic_writer = PdfWriter()
-                        topic_text = []
-                    current_topic = re.sub(r"\s+", "_", header_text)
-                    topic_count += 1
-            topic_writer.add_page(reader.pages[i])
-            if text.strip():
-                topic_text.append(text.strip())
-        if current_topic is not None and len(topic_writer.pages) > 0:
-            pdf_bytes = io.BytesIO()
-            topic_writer.write(pdf_bytes)
-            pdf_bytes.seek(0)
-            full_text = "\n".join(topic_text).strip()
-            topics.append((f"{topic_count:02d}_{current_topic}.pdf", pdf_bytes, full_text))
-    return topics
+    total_pages = len(reader.pages)
+    current_topic = None
+    start_page = 0
+    topic_count = 0
+    topic_buf = io.StringIO()
+    for i, page in enumerate(reader.pages):
+        text = page.extract_text() or ""
+        match = TOPIC_REGEX.search(text)
+        if match:
+            header_text = match.group(0).strip()
+            if header_text.casefold() in MERGE_WITH_PREVIOUS and current_topic is not None:
+                pass
+            else:
+                if current_topic is not None and i > start_page:
+                    full_text = topic_buf.getvalue().strip()
+                    yield f"{topic_count:02d}_{current_topic}.pdf", full_text
+                    start_page = i
+                    topic_buf = io.StringIO()
+                current_topic = _WS_RE.sub("_", header_text)
+                topic_count += 1
+        stripped = text.strip()
+        if stripped:
+            topic_buf.write(stripped)
+            topic_buf.write("\n")
+        if on_page is not None:
+            on_page(i + 1, total_pages)
+    if current_topic is not None and total_pages > start_page:
+        full_text = topic_buf.getvalue().strip()
+        yield f"{topic_count:02d}_{current_topic}.pdf", full_text
 
 def normalize_name(name: str) -> str:
-    return re.sub(r'\s+', '_', name.strip())
+    # str.split() drops leading/trailing whitespace and collapses runs, like strip() + \s+ -> "_"
+    return "_".join(name.split())
 
-def save_to_firebase(subject, chapter, topics):
+def save_to_firebase(subject, chapter, topics, db=None):
     try:
-        db = get_db_client()
+        db = db or get_db_client()
         subject_ref = db.collection("subjects").document(normalize_name(subject))
         chapter_ref = subject_ref.collection("chapters").document(normalize_name(chapter))
-        for i, (filename, _, content) in enumerate(topics, 1):
-            chapter_ref.collection("topics").document(f"topic{i}").set({
+        # One commit per FIRESTORE_BATCH_LIMIT topics instead of one round-trip per topic
+        batch = db.batch()
+        for i, (filename, content) in enumerate(topics, 1):
+            batch.set(chapter_ref.collection("topics").document(f"topic{i}"), {
                 "title": filename.replace(".pdf", ""),
                 "content": content
             })
+            if i % FIRESTORE_BATCH_LIMIT == 0:
+                batch.commit()
+                batch = db.batch()
+        batch.commit()
+        fetch_subjects.clear()
+        fetch_chapters.clear()
+        fetch_topics.clear()
+        fetch_chapters_and_topics.clear()
     except Exception as e:
         st.error(f"Error saving to Firebase: {e}")
         st.error("Please check your Firebase connection and try again.")
 
 # ---------------- FIREBASE QUERY FUNCTIONS ----------------
-def get_subjects():
+# Streamlit reruns the script on every widget interaction; these reads are cached briefly
+# (and cleared after our own writes) so a rerun doesn't re-stream whole collections
+FIRESTORE_CACHE_TTL = 60
+# Topic listings fetch only these fields; ai_timestamp is written together with the plan,
+# so it marks topics that have one without downloading the plan itself
+TOPIC_LIST_FIELDS = ["title", "content", "ai_timestamp"]
+
+@st.cache_data(ttl=FIRESTORE_CACHE_TTL, show_spinner=False)
+def fetch_subjects(_db=None):
+    db = _db or get_db_client()
+    return [subj.id for subj in db.collection("subjects").stream()]
+
+@st.cache_data(ttl=FIRESTORE_CACHE_TTL, show_spinner=False)
+def fetch_chapters(subject, _db=None):
+    db = _db or get_db_client()
+    chapters = db.collection("subjects").document(normalize_name(subject)).collection("chapters").stream()
+    return [chap.id for chap in chapters]
+
+@st.cache_data(ttl=FIRESTORE_CACHE_TTL, show_spinner=False)
+def fetch_topics(subject, chapter, _db=None):
+    db = _db or get_db_client()
+    topics_ref = (db.collection("subjects").document(normalize_name(subject))
+                 .collection("chapters").document(normalize_name(chapter))
+                 .collection("topics"))
+    return [(topic.id, topic.to_dict()) for topic in topics_ref.select(TOPIC_LIST_FIELDS).stream()]
+
+@st.cache_data(ttl=FIRESTORE_CACHE_TTL, show_spinner=False)
+def fetch_chapters_and_topics(subject, chapter, _db=None):
+    """fetch_chapters + fetch_topics as two concurrent queries (one round-trip of latency)"""
+    db = _db or get_db_client()
+    chapters_ref = db.collection("subjects").document(normalize_name(subject)).collection("chapters")
+    topics_ref = chapters_ref.document(normalize_name(chapter)).collection("topics")
+    # The sync client is thread-safe; two short-lived threads overlap the RPCs
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        chapters = executor.submit(lambda: [chap.id for chap in chapters_ref.stream()])
+        topics = executor.submit(lambda: [(topic.id, topic.to_dict())
+                                          for topic in topics_ref.select(TOPIC_LIST_FIELDS).stream()])
+        return chapters.result(), topics.result()
+
+@st.cache_data(ttl=FIRESTORE_CACHE_TTL, show_spinner=False)
+def fetch_topic_plan(subject, chapter, topic_id, _db=None):
+    db = _db or get_db_client()
+    topic_ref = (db.collection("subjects").document(normalize_name(subject))
+                .collection("chapters").document(normalize_name(chapter))
+                .collection("topics").document(topic_id))
+    return (topic_ref.get(field_paths=["ai_plan_markdown"]).to_dict() or {}).get("ai_plan_markdown")
+
+def get_subjects(db=None):
     try:
-        db = get_db_client()
-        subjects = db.collection("subjects").stream()
-        subject_list = [subj.id for subj in subjects]
-        st.write(f"Debug: Found {len(subject_list)} subjects: {subject_list}")
-        return subject_list
+        return fetch_subjects(db)
     except Exception as e:
         st.error(f"Error fetching subjects: {e}")
         st.error("Please check your Firebase connection and try refreshing the page.")
         return []
 
-def get_chapters(subject):
+def get_chapters(subject, db=None):
     if not subject:
         return []
     try:
-        db = get_db_client()
-        chapters = db.collection("subjects").document(normalize_name(subject)).collection("chapters").stream()
-        chapter_list = [chap.id for chap in chapters]
-        st.write(f"Debug: Found {len(chapter_list)} chapters for {subject}: {chapter_list}")
-        return chapter_list
+        return fetch_chapters(subject, db)
     except Exception as e:
         st.error(f"Error fetching chapters: {e}")
         st.error("Please check your Firebase connection and try refreshing the page.")
         return []
 
-def get_topics(subject, chapter):
+def get_topics(subject, chapter, db=None):
     if not subject or not chapter:
         return []
     try:
-        db = get_db_client()
-        topics_ref = (db.collection("subjects").document(normalize_name(subject))
-                     .collection("chapters").document(normalize_name(chapter))
-                     .collection("topics"))
-        topics = topics_ref.stream()
-        topic_list = [(topic.id, topic.to_dict()) for topic in topics]
-        st.write(f"Debug: Found {len(topic_list)} topics for {subject}/{chapter}")
-        return topic_list
+        return fetch_topics(subject, chapter, db)
     except Exception as e:
         st.error(f"Error fetching topics: {e}")
         st.error("Please check your Firebase connection and try refreshing the page.")
         return []
 
-def save_teaching_plan(subject, chapter, topic_id, plan_data):
+def get_chapters_and_topics(subject, chapter, db=None):
+    try:
+        return fetch_chapters_and_topics(subject, chapter, db)
+    except Exception as e:
+        st.error(f"Error fetching chapters and topics: {e}")
+        st.error("Please check your Firebase connection and try refreshing the page.")
+        return [], []
+
+def get_topic_plan(subject, chapter, topic_id, db=None):
+    """Plan markdown for one topic, loaded only when it is shown"""
+    try:
+        return fetch_topic_plan(subject, chapter, topic_id, db)
+    except Exception as e:
+        st.error(f"Error fetching teaching plan: {e}")
+        return None
+
+def save_teaching_plan(subject, chapter, topic_id, plan_data, db=None):
     try:
-        db = get_db_client()
+        db = db or get_db_client()
         topic_ref = (db.collection("subjects").document(normalize_name(subject))
                     .collection("chapters").document(normalize_name(chapter))
                     .collection("topics").document(topic_id))
@@ -351,6 +557,9 @@ def save_teaching_plan(subject, chapter, topic_id, plan_data):
             "ai_model": f"ollama:{OLLAMA_MODEL}",
             "ai_timestamp": firestore.SERVER_TIMESTAMP,
         }, merge=True)
+        fetch_topics.clear()
+        fetch_chapters_and_topics.clear()
+        fetch_topic_plan.clear()
         return True
     except Exception as e:
         st.error(f"Error saving plan: {e}")
@@ -358,22 +567,36 @@ def save_teaching_plan(subject, chapter, topic_id, plan_data):
         return False
 
 # ---------------- STREAMLIT UI ----------------
+def select_subject_chapter(key: str, db=None):
+    """Subject/chapter pickers; returns (subject, chapter, topics). When a chapter of the same subject is
+    already selected from the previous run, its chapter list and topics are read concurrently"""
+    col1, col2 = st.columns(2)
+    with col1:
+        subjects = get_subjects(db)
+        selected_subject = st.selectbox("Select Subject", [""] + subjects, key=f"{key}_subject")
+    with col2:
+        previous_chapter = st.session_state.get(f"{key}_chapter")
+        # After a subject switch the old chapter won't be among the new options, so don't read its topics
+        same_subject = st.session_state.get(f"_{key}_chapter_subject") == selected_subject
+        st.session_state[f"_{key}_chapter_subject"] = selected_subject
+        topics = None
+        if selected_subject and previous_chapter and same_subject:
+            chapters, topics = get_chapters_and_topics(selected_subject, previous_chapter, db)
+        else:
+            chapters = get_chapters(selected_subject, db) if selected_subject else []
+        selected_chapter = st.selectbox("Select Chapter", [""] + chapters, key=f"{key}_chapter")
+    if selected_subject and selected_chapter and (topics is None or selected_chapter != previous_chapter):
+        topics = get_topics(selected_subject, selected_chapter, db)
+    return selected_subject, selected_chapter, topics or []
+
 def main():
     st.title("📚 NCERT AI Teaching Assistant")
     st.markdown("Upload PDFs, extract topics, and generate AI-powered teaching plans!")
 
     st.sidebar.title("Navigation")
     mode = st.sidebar.radio("Choose Mode", ["📄 PDF Upload & Processing", "🤖 AI Teaching Plans", "📖 Browse Content"])
-
-    if mode == "🤖 AI Teaching Plans":
-        try:
-            import requests
-            response = requests.get(f"{OLLAMA_HOST}/api/version", timeout=5)
-            if response.status_code != 200:
-                st.warning("⚠️ Cannot connect to Ollama. Make sure Ollama is running on " + OLLAMA_HOST)
-        except Exception:
-            st.error("❌ Ollama server not accessible. Please start Ollama and ensure the model is available.")
-            st.code(f"ollama serve  # Start Ollama server\nollama pull {OLLAMA_MODEL}  # Ensure model is available")
+    # Resolved once per run and passed down; None (init failed) makes each helper report the error
+    db = init_firebase()
 
     if mode == "📄 PDF Upload & Processing":
         st.header("📄 PDF Upload & Topic Extraction")
@@ -385,47 +608,53 @@ def main():
             uploaded_file = st.file_uploader("Upload Chapter PDF", type=["pdf"])
         if uploaded_file and subject and chapter_name:
             st.subheader(f"📖 Processing {uploaded_file.name}")
-            with st.spinner("Extracting topics from PDF..."):
-                topics = split_pdf_by_topics(uploaded_file)
-            st.success(f"✅ Extracted {len(topics)} topics")
-            for i, (filename, _, content) in enumerate(topics, 1):
+            status = st.empty()
+            progress_bar = st.progress(0.0, text="Extracting topics from PDF...")
+            # Each topic's expander renders as soon as it is split off, while later pages are still read
+            topics = []
+
+            def on_page(done, total):
+                progress_bar.progress(done / total, text=f"Reading page {done}/{total}...")
+
+            for i, (filename, content) in enumerate(split_pdf_by_topics(uploaded_file, on_page), 1):
+                topics.append((filename, content))
                 with st.expander(f"Topic {i}: {filename}"):
                     st.text_area("Extracted Text", content, height=200, key=f"topic_{i}")
+            progress_bar.empty()
+            status.success(f"✅ Extracted {len(topics)} topics")
             if st.button("🚀 Save to Firebase", type="primary"):
                 with st.spinner("Saving to Firebase..."):
-                    save_to_firebase(subject, chapter_name, topics)
+                    save_to_firebase(subject, chapter_name, topics, db)
                 st.success("✅ Topics saved to Firebase!")
 
     elif mode == "🤖 AI Teaching Plans":
         st.header("🤖 AI Teaching Plan Generator (Local Mistral)")
         try:
-            import requests
-            response = requests.get(f"{OLLAMA_HOST}/api/version", timeout=2)
-            if response.status_code == 200:
+            status_code, model_names = probe_ollama()
+            if status_code == 200:
                 st.success(f"✅ Connected to Ollama at {OLLAMA_HOST}")
-                models_response = requests.get(f"{OLLAMA_HOST}/api/tags", timeout=5)
-                if models_response.status_code == 200:
-                    models = models_response.json().get("models", [])
-                    model_names = [m["name"] for m in models]
+                if model_names is not None:
                     if OLLAMA_MODEL in model_names or any(OLLAMA_MODEL in name for name in model_names):
                         st.success(f"✅ Model '{OLLAMA_MODEL}' is available")
                     else:
                         st.error(f"❌ Model '{OLLAMA_MODEL}' not found. Available models: {model_names}")
                         st.code(f"ollama pull {OLLAMA_MODEL}")
             else:
-                st.error(f"❌ Ollama server responded with status {response.status_code}")
+                st.error(f"❌ Ollama server responded with status {status_code}")
         except Exception as e:
             st.error(f"❌ Cannot connect to Ollama: {e}")
             st.info(f"Make sure Ollama is running: `ollama serve`")
+            st.code(f"ollama serve  # Start Ollama server\nollama pull {OLLAMA_MODEL}  # Ensure model is available")
             return
         st.subheader("🔍 Debug Information")
         if st.button("🔄 Refresh Data"):
             st.cache_resource.clear()
+            st.cache_data.clear()
             st.success("Cache cleared! Data will be refreshed on next request.")
             st.rerun()
         with st.expander("Firebase Connection Details"):
             try:
-                db = get_db_client()
+                db = db or get_db_client()
                 st.success("✅ Database connection established")
                 st.write("Testing connection with fresh data...")
                 collections = list(db.collections())
@@ -442,15 +671,8 @@ def main():
             except Exception as e:
                 st.error(f"❌ Firebase connection error: {e}")
                 st.error("Please check your Firebase credentials and internet connection.")
-        col1, col2 = st.columns(2)
-        with col1:
-            subjects = get_subjects()
-            selected_subject = st.selectbox("Select Subject", [""] + subjects)
-        with col2:
-            chapters = get_chapters(selected_subject) if selected_subject else []
-            selected_chapter = st.selectbox("Select Chapter", [""] + chapters)
+        selected_subject, selected_chapter, topics = select_subject_chapter("ai", db)
         if selected_subject and selected_chapter:
-            topics = get_topics(selected_subject, selected_chapter)
             if topics:
                 st.subheader(f"Topics in {selected_subject} > {selected_chapter}")
                 col1, col2 = st.columns([3, 1])
@@ -458,38 +680,32 @@ def main():
                     st.write(f"Found {len(topics)} topics")
                 with col2:
                     if st.button("🚀 Generate All Plans", type="primary"):
-                        generate_all_plans(selected_subject, selected_chapter, topics)
+                        generate_all_plans(selected_subject, selected_chapter, topics, db)
                 for topic_id, topic_data in topics:
                     with st.expander(f"📝 {topic_data.get('title', topic_id)}"):
                         col1, col2 = st.columns([3, 1])
                         with col1:
                             st.text_area("Content", topic_data.get('content', ''), height=150, key=f"content_{topic_id}")
                         with col2:
-                            has_plan = 'ai_plan_markdown' in topic_data
+                            has_plan = 'ai_timestamp' in topic_data
                             if has_plan:
                                 st.success("✅ Plan exists")
                                 if st.button("🔄 Regenerate", key=f"regen_{topic_id}"):
-                                    generate_single_plan(selected_subject, selected_chapter, topic_id, topic_data)
+                                    generate_single_plan(selected_subject, selected_chapter, topic_id, topic_data,
+                                                         use_cache=False, db=db)
                             else:
                                 if st.button("🤖 Generate Plan", key=f"gen_{topic_id}"):
-                                    generate_single_plan(selected_subject, selected_chapter, topic_id, topic_data)
-                        if 'ai_plan_markdown' in topic_data:
+                                    generate_single_plan(selected_subject, selected_chapter, topic_id, topic_data, db=db)
+                        if has_plan and st.toggle("📋 Show Teaching Plan", key=f"show_{topic_id}"):
                             st.markdown("### 📋 Teaching Plan")
-                            st.markdown(topic_data['ai_plan_markdown'])
+                            st.markdown(get_topic_plan(selected_subject, selected_chapter, topic_id, db) or "")
             else:
                 st.info("No topics found. Upload a PDF first!")
 
     elif mode == "📖 Browse Content":
         st.header("📖 Browse Content")
-        col1, col2 = st.columns(2)
-        with col1:
-            subjects = get_subjects()
-            selected_subject = st.selectbox("Select Subject", [""] + subjects)
-        with col2:
-            chapters = get_chapters(selected_subject) if selected_subject else []
-            selected_chapter = st.selectbox("Select Chapter", [""] + chapters)
+        selected_subject, selected_chapter, topics = select_subject_chapter("browse", db)
         if selected_subject and selected_chapter:
-            topics = get_topics(selected_subject, selected_chapter)
             if topics:
                 for topic_id, topic_data in topics:
                     with st.expander(f"📖 {topic_data.get('title', topic_id)}"):
@@ -498,21 +714,40 @@ def main():
                             st.subheader("📄 Content")
                             st.text_area("", topic_data.get('content', ''), height=300)
                         with col2:
-                            if 'ai_plan_markdown' in topic_data:
+                            if 'ai_timestamp' in topic_data:
                                 st.subheader("🤖 AI Teaching Plan")
-                                st.markdown(topic_data['ai_plan_markdown'])
+                                if st.toggle("Show plan", key=f"browse_{topic_id}"):
+                                    st.markdown(get_topic_plan(selected_subject, selected_chapter, topic_id, db) or "")
                             else:
                                 st.info("No teaching plan generated yet.")
 
-def generate_single_plan(subject, chapter, topic_id, topic_data):
+# Live output is redrawn at most this often while a single plan streams in
+STREAM_REFRESH_SECS = 0.25
+
+def generate_single_plan(subject, chapter, topic_id, topic_data, use_cache=True, db=None):
     with st.spinner(f"Generating teaching plan for {topic_data.get('title', topic_id)}..."):
+        live = st.empty()
+        received = []
+        last_draw = 0.0
+
+        def show_progress(piece):
+            nonlocal last_draw
+            received.append(piece)
+            now = time.monotonic()
+            if now - last_draw >= STREAM_REFRESH_SECS:
+                live.code("".join(received)[-2000:], language="json")
+                last_draw = now
+
         try:
             plan_data = generate_teaching_plan(
                 "", subject, chapter,
                 topic_data.get('title', ''),
-                topic_data.get('content', '')
+                topic_data.get('content', ''),
+                use_cache=use_cache,
+                on_text=show_progress
             )
-            if save_teaching_plan(subject, chapter, topic_id, plan_data):
+            live.empty()
+            if save_teaching_plan(subject, chapter, topic_id, plan_data, db):
                 st.success("✅ Teaching plan generated and saved!")
                 st.rerun()
             else:
@@ -520,29 +755,58 @@ def generate_single_plan(subject, chapter, topic_id, topic_data):
         except Exception as e:
             st.error(f"❌ Error generating plan: {e}")
 
-def generate_all_plans(subject, chapter, topics):
+async def agenerate_all_plans(subject, chapter, pending, on_done):
+    """Generate plans for [(topic_id, topic_data), ...] concurrently; on_done(topic_id, topic_data, result)
+    is called as each finishes, with the plan dict or the exception it raised"""
+    semaphore = asyncio.Semaphore(OLLAMA_NUM_PARALLEL)
+    limits = httpx.Limits(max_connections=OLLAMA_NUM_PARALLEL, max_keepalive_connections=OLLAMA_NUM_PARALLEL)
+
+    async with httpx.AsyncClient(limits=limits) as client:
+        async def run(topic_id, topic_data):
+            async with semaphore:
+                try:
+                    # fetch_topics already projects 'content'; a topic without it is reported, not planned from ''
+                    if 'content' not in topic_data:
+                        raise ValueError("topic has no 'content' field")
+                    return topic_id, topic_data, await agenerate_teaching_plan(
+                        client, "", subject, chapter,
+                        topic_data.get('title', ''),
+                        topic_data['content']
+                    )
+                except Exception as e:
+                    return topic_id, topic_data, e
+
+        for done in asyncio.as_completed([run(topic_id, topic_data) for topic_id, topic_data in pending]):
+            on_done(*(await done))
+
+def generate_all_plans(subject, chapter, topics, db=None):
+    db = db or init_firebase()
     progress_bar = st.progress(0)
     status_text = st.empty()
     success_count = 0
     total_topics = len(topics)
-    for i, (topic_id, topic_data) in enumerate(topics):
-        if 'ai_plan_markdown' in topic_data:
-            status_text.text(f"Skipping {topic_data.get('title', topic_id)} (already exists)")
+    pending = []
+    for topic_id, topic_data in topics:
+        if 'ai_timestamp' in topic_data:
             success_count += 1
         else:
-            status_text.text(f"Generating plan for {topic_data.get('title', topic_id)}...")
-            try:
-                plan_data = generate_teaching_plan(
-                    "", subject, chapter,
-                    topic_data.get('title', ''),
-                    topic_data.get('content', '')
-                )
-                if save_teaching_plan(subject, chapter, topic_id, plan_data):
-                    success_count += 1
-                time.sleep(1)
-            except Exception as e:
-                st.error(f"Error generating plan for {topic_id}: {e}")
-        progress_bar.progress((i + 1) / total_topics)
+            pending.append((topic_id, topic_data))
+    finished = success_count
+    progress_bar.progress(finished / total_topics)
+    status_text.text(f"Generating {len(pending)} plans ({success_count} already exist)...")
+
+    def on_done(topic_id, topic_data, result):
+        nonlocal success_count, finished
+        finished += 1
+        if isinstance(result, Exception):
+            st.error(f"Error generating plan for {topic_id}: {result}")
+        elif save_teaching_plan(subject, chapter, topic_id, result, db):
+            success_count += 1
+            status_text.text(f"Generated plan for {topic_data.get('title', topic_id)}")
+        progress_bar.progress(finished / total_topics)
+
+    if pending:
+        asyncio.run(agenerate_all_plans(subject, chapter, pending, on_done))
     status_text.text(f"Completed! Generated {success_count}/{total_topics} plans.")
     st.success(f"✅ Generated {success_count} teaching plans!")
     time.sleep(2)